@@ -1,9 +1,19 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import os
-import json
 import time
+import threading
+from collections import OrderedDict, defaultdict
 from datetime import datetime, timedelta, timezone # <--- 新增這個
+# 純計算放在 ledger_jobs.py (背景工作的 process pool 要 import 得到，不能放在這個 streamlit 腳本裡)
+from ledger_jobs import LEDGER_COLUMNS, OPENING_BALANCE_ITEM, row_to_dict, spending_mask, compute_balances, compute_transfers
+# 帳本的檔案讀寫 (事件紀錄、快照、共用的目前帳本) 放在 ledger_store.py，測試也能直接 import
+import ledger_store
+from ledger_store import DATA_FILE, LOG_FILE, get_ledger_version, read_events, get_ledger_feed, load_ledger, \
+    record_operation, get_undo_redo_stacks, undo_last_operation, redo_last_operation, load_members, save_members
+# 背景工作 (改名、封存、上傳還原、重建歷史總覽) 放在 ledger_tasks.py
+from ledger_tasks import JOB_POLL_SECONDS, JOB_SHOW_DONE_SECONDS, JobRunner, run_rename_job, run_archive_job, run_restore_job, run_history_summary_job
 
 # --- 設定 ---
 # 定義台灣時區 (UTC+8)
@@ -15,21 +25,443 @@ INT_CURRENCIES = ['TWD', 'JPY', 'KRW', 'VND']
 # 定義所有支援幣別
 CURRENCIES = ['TWD', 'JPY', 'USD', 'EUR']
 
-# --- 設定檔案路徑 ---
-DATA_FILE = 'trip_ledger.csv'      # 存帳務資料
-CONFIG_FILE = 'members.json'       # 存成員名單
+# --- 設定檔案路徑 (帳本的檔案在 ledger_store.py) ---
+LIVE_REFRESH_SECONDS = 3  # 多久檢查一次別人有沒有存新帳
 CURRENCIES = ['JPY', 'TWD', 'USD', 'EUR'] # 這裡可以自己擴充
 
-# --- 函數：讀取與儲存成員 ---
-def load_members():
-    if os.path.exists(CONFIG_FILE):
-        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return []
+# --- 函數：結算儀表板計算 (每個幣別分開快取) ---
+# 小幫手函數：聰明格式化 (整數就不顯示 .00)
+def smart_fmt(val):
+    if float(val).is_integer():
+        return f"{val:,.0f}"
+    return f"{val:,.2f}"
 
-def save_members(members_list):
-    with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-        json.dump(members_list, f, ensure_ascii=False)
+@st.cache_data(show_spinner=False, max_entries=4)
+def list_currencies(version, _df):
+    # _df 開頭是底線：streamlit 不拿它算快取 key，key 只看版本 (版本和帳本要是 load_ledger 同一次拿到的)
+    return sorted(_df['Currency'].dropna().astype(str).unique())
+
+def build_status_table_html(sorted_bal):
+    html_parts = []
+    html_parts.append('<table class="styled-table"><thead><tr><th>成員</th><th>淨額</th><th>狀態</th></tr></thead><tbody>')
+
+    for member, net in sorted_bal:
+        net_val = float(net)
+        formatted_net = smart_fmt(abs(net_val))
+
+        if net_val > 0.01:
+            row_cls = "status-green"
+            badge = "<span style='background:#f6ffed; color:#4DB6AC; padding:2px 8px; border-radius:10px; font-size:0.8rem; font-weight:bold;'>收錢錢囉✨💰</span>"
+            color = "#4DB6AC"
+            txt = f"+{formatted_net}"
+        elif net_val < -0.01:
+            row_cls = "status-red"
+            badge = "<span style='background:#fff1f0; color:#FF8A65; padding:2px 8px; border-radius:10px; font-size:0.8rem; font-weight:bold;'>繳錢錢囉💵</span>"
+            color = "#FF8A65"
+            txt = f"-{formatted_net}"
+        else:
+            row_cls = "status-gray"
+            badge = "<span style='color:#888; font-size:0.8rem;'>平帳</span>"
+            color = "#ccc"
+            txt = "0"
+
+        row_html = f'<tr class="{row_cls}"><td style="font-weight:500;">{member}</td><td class="tabular-nums" style="color:{color}; font-weight:600;">{txt}</td><td>{badge}</td></tr>'
+        html_parts.append(row_html)
+    html_parts.append('</tbody></table>')
+    final_table_html = "".join(html_parts)
+    return f'<div class="premium-card" style="padding:0; overflow:hidden;">{final_table_html}</div>'
+
+def build_transfer_ticket_html(t):
+    return f"""
+    <div class="transfer-ticket">
+        <div class="ticket-side">
+            <div class="ticket-label">付款</div>
+            <div class="ticket-name">{t['from']}</div>
+        </div>
+        <div class="ticket-center">
+            <div class="ticket-arrow">➜</div>
+            <div class="ticket-amount">${smart_fmt(t['amount'])}</div>
+        </div>
+        <div class="ticket-side">
+            <div class="ticket-label">收款</div>
+            <div class="ticket-name">{t['to']}</div>
+        </div>
+    </div>"""
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def compute_currency_summary(version, currency, members, _df):
+    # 只算「被點開的那個幣別」，結果依 (帳本版本, 幣別, 成員) 快取
+    # 幣別再多，每次 rerun 也只付一個幣別的成本
+    group = _df[_df['Currency'].astype(str) == currency]
+
+    # --- A. 計算邏輯 ---
+    balances, total_spend = compute_balances(group, members)
+
+    # --- B. 總計 ---
+    avg_spend = total_spend / len(members) if members else 0
+
+    # --- C. 排序 ---
+    sorted_bal, transfer_list = compute_transfers(balances)
+
+    # HTML 也一起算好放進快取，畫面只負責貼上
+    return {
+        'balances': balances,
+        'total_spend': total_spend,
+        'avg_spend': avg_spend,
+        'transfer_list': transfer_list,
+        'table_html': build_status_table_html(sorted_bal),
+        'tickets_html': [build_transfer_ticket_html(t) for t in transfer_list],
+    }
+
+# --- 函數：日期索引 (只解析一次、排好序，用二分搜尋切時間區間) ---
+DATE_FORMAT = '%Y-%m-%d %H:%M'
+
+@st.cache_resource(show_spinner=False, max_entries=2)
+def build_date_index(version, _df):
+    # 用 cache_resource 避免每次 rerun 都複製整本帳 (拿到的人只能讀、不能改)
+    df = _df
+    ts = pd.to_datetime(df['Date'], format=DATE_FORMAT, errors='coerce')
+    valid = ts.dropna()
+    # 壞掉的日期當成最舊的排最前面；mergesort 是穩定排序，同一分鐘的紀錄維持存檔順序
+    ts_filled = ts.fillna(pd.Timestamp.min)
+    order = ts_filled.argsort(kind='mergesort').to_numpy()
+    return {
+        'df': df.assign(_ts=ts).iloc[order],
+        'ts': ts_filled.iloc[order].to_numpy(),
+        'first_day': valid.min().normalize() if not valid.empty else None,
+        'last_day': valid.max().normalize() if not valid.empty else None,
+    }
+
+def slice_by_time(date_index, start=None, end=None):
+    # 區間是 [start, end) 左閉右開；兩次二分搜尋就切好，不用掃整本帳
+    ts = date_index['ts']
+    lo = 0 if start is None else ts.searchsorted(pd.Timestamp(start).to_datetime64(), side='left')
+    hi = len(ts) if end is None else ts.searchsorted(pd.Timestamp(end).to_datetime64(), side='left')
+    return date_index['df'].iloc[lo:hi]
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def compute_spend_summary(version, start, end, _df):
+    # 每日花費 / 每人分攤 (不含還款、期初結轉)，全部用 resample / groupby 向量化計算
+    sliced = slice_by_time(build_date_index(version, _df), start, end)
+    spend = sliced[spending_mask(sliced)].dropna(subset=['_ts'])
+    if spend.empty:
+        return None
+
+    spend = spend.assign(Amount=spend['Amount'].astype(float))
+    daily = spend.set_index('_ts').groupby('Currency')['Amount'].resample('D').sum().unstack('Currency', fill_value=0)
+
+    # 把分帳人拆開，一人一列，算出每個人分到的金額
+    shares = spend[['_ts', 'Currency', 'Amount']].assign(Member=spend['Beneficiaries'].astype(str).str.split(',')).explode('Member')
+    shares['Member'] = shares['Member'].str.strip()
+    shares = shares[shares['Member'] != '']
+    shares['Share'] = shares['Amount'] / shares.groupby(level=0)['Member'].transform('size')
+
+    per_member = shares.groupby(['Member', 'Currency'])['Share'].sum().unstack('Currency', fill_value=0)
+    member_daily = shares.set_index('_ts').groupby(['Member', 'Currency'])['Share'].resample('D').sum()
+    return {'daily': daily, 'per_member': per_member, 'member_daily': member_daily}
+
+# --- 函數：項目搜尋 (n-gram 倒排索引，中文沒有空白斷詞也搜得到) ---
+class ItemSearchIndex:
+    # postings: 字 / 兩字組 -> 出現的位置，每個位置編成 row_id * POSITION_RANGE + 第幾個字
+    # arrays: 同樣的東西轉成排好的 numpy array，查詢直接拿來用 (改過的字組才丟掉重做)
+    # items: row id -> 小寫後的項目名稱；row id 就是帳本的 Id (跟 df 的 index 一樣)
+    POSITION_RANGE = 1 << 16  # 項目名稱只索引前 65536 個字，實際上不會那麼長
+
+    def __init__(self):
+        self.postings = defaultdict(set)
+        self.arrays = {}
+        self.items = {}
+        self.version = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def grams(cls, text):
+        # 單字 + 相鄰兩字，連同位置一起列出來：查一個字用單字表，查兩個字以上用兩字組
+        text = text[:cls.POSITION_RANGE]
+        out = [(c, i) for i, c in enumerate(text)]
+        out += [(text[i:i + 2], i) for i in range(len(text) - 1)]
+        return out
+
+    def add(self, row_id, item):
+        text = "" if pd.isna(item) else str(item).lower()
+        self.items[row_id] = text
+        base = int(row_id) * self.POSITION_RANGE
+        for g, pos in self.grams(text):
+            self.postings[g].add(base + pos)
+            self.arrays.pop(g, None)
+
+    def remove(self, row_id):
+        text = self.items.pop(row_id, None)
+        if text is None:
+            return
+        base = int(row_id) * self.POSITION_RANGE
+        for g, pos in self.grams(text):
+            codes = self.postings.get(g)
+            if codes is not None:
+                codes.discard(base + pos)
+                if not codes:
+                    del self.postings[g]
+            self.arrays.pop(g, None)
+
+    def apply_changes(self, changes):
+        for change in changes:
+            self.remove(change['id'])
+            if change['after'] is not None:
+                self.add(change['id'], change['after']['Item'])
+
+    def rebuild(self, version, df):
+        self.postings = defaultdict(set)
+        self.arrays = {}
+        self.items = {}
+        for row_id, item in zip(df.index, df['Item']):
+            self.add(row_id, item)
+        # 重建時順便把全部的 array 做好，第一次查詢就不用等
+        for g in self.postings:
+            self.get_array(g)
+        self.version = version
+
+    def sync(self, version, df):
+        # 別人 (或上傳還原、封存) 改了帳本，沒辦法增量更新，就整本重建
+        # 版本號只會變大：拿著舊版本的 session 不要把索引倒回去
+        with self.lock:
+            if self.version is None or version > self.version:
+                self.rebuild(version, df)
+
+    def get_array(self, g):
+        arr = self.arrays.get(g)
+        if arr is None:
+            codes = self.postings.get(g)
+            if codes is None:
+                return np.empty(0, dtype=np.int64)  # 沒出現過的字組不要記，不然亂打的查詢會一直佔記憶體
+            arr = np.fromiter(codes, dtype=np.int64, count=len(codes))
+            arr.sort()
+            self.arrays[g] = arr
+        return arr
+
+    def search(self, query):
+        # 回傳有出現 query 的 row id (排好的 numpy array)；query 是空的就回傳 None
+        q = query.strip().lower()
+        if not q:
+            return None
+        with self.lock:
+            if len(q) == 1:
+                matches = self.get_array(q)
+            else:
+                # 第 j 個字開始的兩字組位置往回移 j 格，全部都對得上的位置就是整串字的開頭，
+                # 交集出來就是答案，不用再一筆一筆比對字串。
+                # 兩字組不用每個都拿：每隔一個字取一個 (加上最後一個) 就能蓋滿整串字
+                offsets = sorted(set(range(0, len(q) - 1, 2)) | {len(q) - 2})
+                shifted = sorted((self.get_array(q[j:j + 2]) - j for j in offsets), key=len)
+                matches = shifted[0]
+                for arr in shifted[1:]:
+                    if len(matches) == 0:
+                        break
+                    # matches 比較短：到 arr 裡二分搜尋
+                    idx = arr.searchsorted(matches).clip(max=len(arr) - 1)
+                    matches = matches[arr[idx] == matches]
+            # matches 是排好的，同一筆出現好幾次會排在一起，去掉相鄰重複的就好 (比 np.unique 快很多)
+            ids = matches // self.POSITION_RANGE
+            if len(ids) > 1:
+                ids = ids[np.concatenate(([True], ids[1:] != ids[:-1]))]
+            return ids
+
+@st.cache_resource
+def get_search_index():
+    return ItemSearchIndex()
+
+def update_search_index(event):
+    # 自己寫入的事件直接增量更新索引；如果索引不是這筆事件的前一版 (中間有別人寫入)，就不動它，等下次 sync 重建
+    index = get_search_index()
+    with index.lock:
+        if index.version != event['seq'] - 1:
+            return
+        index.apply_changes(event['changes'])
+        index.version = event['seq']
+
+# --- 函數：帳務明細卡片 HTML (跨 session 共用的 LRU 快取) ---
+CARD_CACHE_SIZE = 5000  # 最多記住幾張卡片，超過就丟掉最久沒用的
+
+class CardHtmlCache:
+    # 簡單的 LRU：OrderedDict 尾端是最近用過的，另外記命中/未命中次數給後台看
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, keys):
+        # 一整頁的卡片一次查完，只拿一次鎖
+        with self.lock:
+            found = []
+            for key in keys:
+                html = self.data.get(key)
+                if html is None:
+                    self.misses += 1
+                else:
+                    self.data.move_to_end(key)
+                    self.hits += 1
+                found.append(html)
+            return found
+
+    def put(self, key, html):
+        with self.lock:
+            self.data[key] = html
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def invalidate_many(self, keys):
+        with self.lock:
+            for key in keys:
+                self.data.pop(key, None)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            hit_rate = self.hits / total if total else 0.0
+            return {'size': len(self.data), 'hits': self.hits, 'misses': self.misses, 'hit_rate': hit_rate}
+
+@st.cache_resource
+def get_card_cache():
+    # cache_resource：整個 server 只有一份，所有人的 session 共用
+    return CardHtmlCache(CARD_CACHE_SIZE)
+
+def hash_card_rows(frame):
+    # 同樣內容的紀錄一定得到同樣的 key；改過內容 key 就變了 (Id 不算進去)
+    # 先統一成 row_to_dict 的格式再整批雜湊，帳本的列和事件裡的 before 才會算出一樣的 key
+    # (NaN / None、舊 CSV 的整數金額 100 / 100.0 都統一)
+    columns = {}
+    for c in LEDGER_COLUMNS:
+        if c == 'Amount':
+            columns[c] = frame[c].astype(float)
+        else:
+            columns[c] = frame[c].astype(str).astype(object).where(frame[c].notna(), None)
+    return pd.util.hash_pandas_object(pd.DataFrame(columns, index=frame.index), index=False)
+
+@st.cache_resource(show_spinner=False, max_entries=2)
+def build_card_keys(version, _df):
+    # 同一版本的帳本只算一次，畫卡片時用 Id 查 (拿到的人只能讀、不能改)
+    return hash_card_rows(_df).to_dict()
+
+def build_card_html(row):
+    is_settlement = "還款" in str(row['Item'])
+    is_opening = OPENING_BALANCE_ITEM in str(row['Item'])
+    currency = row['Currency']
+    amount = float(row['Amount'])
+    date_str = str(row['Date'])[5:] 
+    item_name = row['Item']
+    payer = row['Payer']
+    bens = [b.strip() for b in str(row['Beneficiaries']).split(",") if b.strip()]
+
+    # 聰明金額格式
+    if amount.is_integer():
+        formatted_amount = f"{amount:,.0f}"
+    else:
+        formatted_amount = f"{amount:,.2f}"
+
+    if is_opening:
+        icon = "📌"
+        amount_color = "#64748B" # 灰色：上一期帶過來的，不是新的花費
+        amount_display = f"{currency} {formatted_amount}"
+    elif is_settlement:
+        icon = "🤝"
+        amount_color = "#16A34A" # 綠色
+        amount_display = f"+ {currency} {formatted_amount}"
+    else:
+        icon = "💸"
+        amount_color = "#DC2626" # 紅色
+        amount_display = f"- {currency} {formatted_amount}"
+
+    # --- HTML 組合 ---
+    # 1. 標題列：[圖示] [項目名稱] -------- [金額]
+    # 使用 Flexbox 讓金額自動靠右
+    header_html = f"""
+    <div style="display: flex; justify-content: space-between; align-items: flex-start; margin-bottom: 2px;">
+        <div style="font-weight:bold; font-size:1rem; color:#334155; display:flex; align-items:center; gap:6px;">
+            <span style="font-size:1.2rem;">{icon}</span>
+            <span>{item_name}</span>
+        </div>
+        <div style="font-weight:bold; color:{amount_color}; font-size:1rem; white-space:nowrap; margin-left:8px;">
+            {amount_display}
+        </div>
+    </div>
+    """
+
+    # 2. 成員與日期列
+    # 付款人 Tag
+    payer_html = f"<span style='background-color: #475569; color: white; padding: 1px 6px; border-radius: 6px; font-size: 0.75rem; font-weight: bold; white-space:nowrap;'>{payer}</span>"
+
+    # 分帳人 Tag (全部顯示，沒有 [:3] 限制)
+    bens_html_parts = []
+    for b in bens:
+        tag = f"<span style='border: 1px solid #CBD5E1; color: #475569; padding: 0px 5px; border-radius: 6px; font-size: 0.75rem; white-space:nowrap;'>{b}</span>"
+        bens_html_parts.append(tag)
+    bens_html = "".join(bens_html_parts)
+
+    # 組合人員列
+    # 使用我們定義的 .people-container 讓它自動換行
+    people_html = f"""
+    <div class="people-container">
+        {payer_html}
+        <span style='color:#ccc; font-size:0.8rem;'>➜</span>
+        {bens_html}
+        <span style="color:#94A3B8; font-size:0.75rem; margin-left: auto;">{date_str}</span>
+    </div>
+    """
+
+    return header_html + people_html
+
+# --- 函數：寫入帳本 (新增 / 修改 / 刪除 / 復原都走 ledger_store.record_operation) ---
+OP_LABELS = {'add': '➕ 新增', 'edit': '✏️ 修改', 'delete': '🗑️ 刪除', 'rename': '🔧 改名', 'undo': '↩️ 復原', 'redo': '↪️ 重做'}
+
+def forget_changed_cards(event):
+    # 被改掉 / 刪掉的那一列，卡片 HTML 用不到了，從共用快取拿掉
+    befores = [change['before'] for change in event['changes'] if change['before'] is not None]
+    if befores:
+        get_card_cache().invalidate_many(hash_card_rows(pd.DataFrame(befores, columns=LEDGER_COLUMNS)).tolist())
+
+# 帳本每一筆新事件 (自己寫的、別人寫的) 都讓搜尋索引增量更新、卡片快取清掉舊的那列
+ledger_store.set_event_listener('search_index', update_search_index)
+ledger_store.set_event_listener('card_cache', forget_changed_cards)
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def load_recent_operations(version):
+    # LOG_FILE 有壓縮控制大小，整個讀進來也很快
+    events = read_events()
+    done, undone = get_undo_redo_stacks(events)
+    return events[-10:][::-1], len(done), len(undone)
+
+# --- 函數：背景工作 (JobRunner 和各個工作在 ledger_tasks.py) ---
+@st.cache_resource
+def get_job_runner():
+    return JobRunner()
+
+def start_job(name, resources, work, *args):
+    job, busy = get_job_runner().submit(name, resources, work, *args)
+    if busy:
+        st.toast(f"「{busy}」還在跑，等它做完再試", icon="⏳")
+        return None
+    st.toast(f"「{name}」已經在背景開始了", icon="🛠️")
+    return job
+
+def collect_rename_jobs():
+    # 自己開的改名工作做完了：成功才重新讀成員名單 (名單是工作成功後才寫的)；回傳名單有沒有換
+    pending = st.session_state.get('rename_jobs', set())
+    if not pending:
+        return False
+    jobs = {job['id']: job for job in get_job_runner().snapshot()}
+    renamed = False
+    for job_id in list(pending):
+        job = jobs.get(job_id)
+        if job is not None and job['status'] == 'running':
+            continue
+        pending.discard(job_id)
+        if job is not None and job['status'] == 'done':
+            renamed = True
+    if renamed:
+        st.session_state['members'] = load_members()
+    return renamed
 
 # --- 初始化 ---
 st.set_page_config(page_title="旅程分帳系統", layout="centered")
@@ -37,6 +469,7 @@ st.set_page_config(page_title="旅程分帳系統", layout="centered")
 # 讀取現有成員
 if 'members' not in st.session_state:
     st.session_state['members'] = load_members()
+collect_rename_jobs()
 
 # --- 側邊欄：成員管理 (深色質感版) ---
 with st.sidebar:
@@ -120,29 +553,16 @@ with st.sidebar:
             
             if action == "修改名字":
                 rename_input = st.text_input(f"把 {target_member} 改為")
+                st.caption("⚠️ 改名之後，之前的操作就不能再復原了")
                 if st.button("確認改名"):
                     if rename_input and rename_input != target_member:
-                        # 更新名單
-                        st.session_state['members'] = [rename_input if x == target_member else x for x in st.session_state['members']]
-                        save_members(st.session_state['members'])
-                        # 更新帳本 (這段邏輯保留)
-                        if os.path.exists(DATA_FILE):
-                            df_update = pd.read_csv(DATA_FILE)
-                            # 清洗 Unnamed
-                            df_update = df_update.loc[:, ~df_update.columns.str.contains('^Unnamed')]
-                            
-                            df_update['Payer'] = df_update['Payer'].replace(target_member, rename_input)
-                            def update_bens(b_str):
-                                if pd.isna(b_str): return b_str
-                                names = str(b_str).split(',')
-                                new_names = [rename_input if n.strip() == target_member else n.strip() for n in names]
-                                return ",".join(new_names)
-                            df_update['Beneficiaries'] = df_update['Beneficiaries'].apply(update_bens)
-                            df_update.to_csv(DATA_FILE, index=False)
-                        
-                        st.success("改名成功！")
-                        time.sleep(0.5)
-                        st.rerun()
+                        # 帳本裡的名字交給背景工作去改 (帳本很大時也不會卡住畫面)
+                        # 名單等工作成功才會換 (collect_rename_jobs)
+                        job = start_job("改名", {'ledger'}, run_rename_job, target_member, rename_input)
+                        if job:
+                            st.session_state.setdefault('rename_jobs', set()).add(job['id'])
+                            time.sleep(0.5)
+                            st.rerun()
             
             elif action == "移除成員":
                 st.caption(f"⚠️ 移除不會刪除 {target_member} 的記帳紀錄")
@@ -155,19 +575,11 @@ with st.sidebar:
 
         # B. 階段性結算 (關帳)
         st.caption("🔒 帳務封存")
+        carry_forward = st.checkbox("沒結清的欠款帶到新帳本", value=True)
         if st.button("封存目前帳本並開新局"):
-             if os.path.exists(DATA_FILE):
-                if not os.path.exists("history"): os.makedirs("history")
-                timestamp = pd.Timestamp.now().strftime('%Y%m%d_%H%M%S')
-                backup_file = f"history/ledger_{timestamp}.csv"
-                df_current = pd.read_csv(DATA_FILE)
-                df_current.to_csv(backup_file, index=False)
-                # 清空
-                empty_df = pd.DataFrame(columns=['Date', 'Item', 'Payer', 'Amount', 'Currency', 'Beneficiaries'])
-                empty_df.to_csv(DATA_FILE, index=False)
-                st.success(f"已封存！")
-                time.sleep(1)
-                st.rerun()
+             if os.path.exists(DATA_FILE) or os.path.exists(LOG_FILE):
+                # 匯出封存檔、算期初結轉、開新帳本都在背景做
+                start_job("封存帳本", {'ledger', 'history'}, run_archive_job, list(st.session_state['members']), carry_forward)
         
         # C. 歷史下載
         if os.path.exists("history"):
@@ -193,22 +605,63 @@ if not st.session_state['members']:
     st.info("👈 請先在左側側邊欄「新增成員」才能開始記帳喔！")
     st.stop()
 
-# 1. 讀取/初始化帳務資料
-if os.path.exists(DATA_FILE):
-    df = pd.read_csv(DATA_FILE)
-    
-    # --- 🔥 新增這行：自動清洗髒資料 ---
-    # 如果發現有 'Unnamed: 0' 這種奇怪的欄位 (Excel 或舊存檔造成的)，直接刪除
-    df = df.loc[:, ~df.columns.str.contains('^Unnamed')]
-    
-else:
-    df = pd.DataFrame(columns=['Date', 'Item', 'Payer', 'Amount', 'Currency', 'Beneficiaries'])
+# 1. 讀取/初始化帳務資料 (同一版本的帳本只讀一次檔，清洗 Unnamed 欄位也在裡面)
+ledger_version, df = load_ledger()
+# 項目搜尋索引：自己存檔時已經增量更新過；版本對不上 (別人改了帳本) 才整本重建
+get_search_index().sync(ledger_version, df)
+# 每次整頁重跑都先當作沒有開著的彈出視窗 (彈出視窗自己會再標記)
+# 彈出視窗都設 on_dismiss="rerun"：按 X / Esc 關掉也會整頁重跑，這個標記才會清掉、即時同步才會恢復
+st.session_state['dialog_open'] = False
+
+# --- 即時同步：別人存了新帳，其他人的畫面自己更新 ---
+@st.fragment(run_every=LIVE_REFRESH_SECONDS)
+def watch_ledger_changes(seen_version, showing_jobs):
+    # 每隔幾秒只讀一下版本號 (LOG_FILE 最後一行)，有新版本才整頁重跑；
+    # 重跑時 load_ledger 也只會套用新的事件，不會整本重讀
+    latest_version = get_ledger_version()
+    # 別人開了背景工作：整頁重跑才會開始顯示進度條
+    jobs_started = not showing_jobs and get_job_runner().has_visible_jobs()
+    if latest_version == seen_version and not jobs_started:
+        return
+    if st.session_state.get('dialog_open'):
+        # 正在填彈出視窗，重跑會把視窗關掉，先提醒就好
+        if latest_version != seen_version and st.session_state.get('notified_version') != latest_version:
+            st.session_state['notified_version'] = latest_version
+            st.toast("有人更新了帳本，關掉視窗後就會看到", icon="🔔")
+        return
+    st.rerun()
+
+# 沒有背景工作時不放進度區，就不用每秒重跑一次
+showing_jobs = get_job_runner().has_visible_jobs()
+watch_ledger_changes(ledger_version, showing_jobs)
+
+# --- 背景工作進度 (所有人都看得到，避免有人同時去改帳) ---
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def show_job_progress():
+    # 自己的改名做完了要換名單、工作都顯示完了要停掉每秒更新：都要整頁重跑 (開著彈出視窗時等它關掉再說)
+    renamed = collect_rename_jobs()
+    if (renamed or not get_job_runner().has_visible_jobs()) and not st.session_state.get('dialog_open'):
+        st.rerun()
+    now = time.time()
+    for job in get_job_runner().snapshot():
+        if job['status'] == 'running':
+            st.progress(job['progress'], text=f"⏳ {job['name']}：{job['message']}")
+        elif job['finished'] and now - job['finished'] < JOB_SHOW_DONE_SECONDS:
+            if job['status'] == 'done':
+                message = job['result'] if isinstance(job['result'], str) else "完成"
+                st.success(f"✅ {job['name']}：{message}")
+            else:
+                st.error(f"❌ {job['name']}：{job['message']}")
+
+if showing_jobs:
+    show_job_progress()
 
 # --- 定義彈出視窗函數 (放在主邏輯之前) ---
 
 # A. 新增用的彈出視窗 (簡潔版：單一模式，不顯示切換選單)
-@st.dialog("➕ 新增紀錄")
+@st.dialog("➕ 新增紀錄", on_dismiss="rerun")
 def add_entry_dialog(mode):
+    st.session_state['dialog_open'] = True
     # mode: 0 = 一般消費, 1 = 結帳還款
 
     # --- 情況一：一般消費 ---
@@ -261,13 +714,6 @@ def add_entry_dialog(mode):
 
 # --- 輔助函數：存檔 (修正時區) ---
 def save_entry(item, payer, amount, currency, beneficiaries):
-    if os.path.exists(DATA_FILE):
-        df = pd.read_csv(DATA_FILE)
-        # 清洗舊資料 (避免 Unnamed 欄位)
-        df = df.loc[:, ~df.columns.str.contains('^Unnamed')]
-    else:
-        df = pd.DataFrame(columns=['Date', 'Item', 'Payer', 'Amount', 'Currency', 'Beneficiaries'])
-    
     # 使用台灣時間
     tw_now = datetime.now(TW_TIMEZONE).strftime('%Y-%m-%d %H:%M')
 
@@ -275,13 +721,13 @@ def save_entry(item, payer, amount, currency, beneficiaries):
         'Date': tw_now,
         'Item': item,
         'Payer': payer,
-        'Amount': amount,
+        'Amount': float(amount),
         'Currency': currency,
         'Beneficiaries': ",".join(beneficiaries)
     }
     
-    df = pd.concat([df, pd.DataFrame([new_entry])], ignore_index=True)
-    df.to_csv(DATA_FILE, index=False)
+    # 只在操作紀錄後面加一行，不用整本重寫
+    record_operation('add', [{'id': None, 'before': None, 'after': new_entry}])
     
     st.success("已儲存！")
     st.balloons()
@@ -289,8 +735,9 @@ def save_entry(item, payer, amount, currency, beneficiaries):
     st.rerun()
 
 # --- B. 修改用的彈出視窗 ---
-@st.dialog("✏️ 修改紀錄")
+@st.dialog("✏️ 修改紀錄", on_dismiss="rerun")
 def edit_entry_dialog(index, row_data):
+    st.session_state['dialog_open'] = True
     # 解析舊資料
     original_beneficiaries = str(row_data['Beneficiaries']).split(",")
     # 過濾有效成員
@@ -326,17 +773,20 @@ def edit_entry_dialog(index, row_data):
         col_btn_a, col_btn_b = st.columns([1, 1])
         with col_btn_a:
             if st.form_submit_button("💾 保存修改", type="primary"):
-                if os.path.exists(DATA_FILE):
-                    df = pd.read_csv(DATA_FILE)
-                    df = df.loc[:, ~df.columns.str.contains('^Unnamed')]
-                    
-                    df.at[index, 'Item'] = item
-                    df.at[index, 'Amount'] = amount
-                    df.at[index, 'Payer'] = payer
-                    df.at[index, 'Currency'] = currency
-                    df.at[index, 'Beneficiaries'] = ",".join(beneficiaries)
-                    
-                    df.to_csv(DATA_FILE, index=False)
+                before = row_to_dict(row_data)
+                after = dict(before)
+                after['Item'] = item
+                after['Amount'] = float(amount)
+                after['Payer'] = payer
+                after['Currency'] = currency
+                after['Beneficiaries'] = ",".join(beneficiaries)
+                
+                # 改之前的樣子也會記下來，可以復原，也查得到誰改過
+                try:
+                    record_operation('edit', [{'id': index, 'before': before, 'after': after}])
+                except RuntimeError as e:
+                    st.toast(str(e), icon="⚠️")
+                else:
                     st.success("修改完成！")
                     st.rerun()
                     
@@ -345,10 +795,11 @@ def edit_entry_dialog(index, row_data):
     col_del_1, col_del_2 = st.columns([3, 2])
     with col_del_2:
         if st.button("🗑️ 刪除此筆資料", type="secondary", use_container_width=True):
-            if os.path.exists(DATA_FILE):
-                df = pd.read_csv(DATA_FILE)
-                df = df.drop(index)
-                df.to_csv(DATA_FILE, index=False)
+            try:
+                record_operation('delete', [{'id': index, 'before': row_to_dict(row_data), 'after': None}])
+            except RuntimeError as e:
+                st.toast(str(e), icon="⚠️")
+            else:
                 st.success("已刪除！")
                 st.rerun()
 
@@ -390,6 +841,37 @@ with st.container(border=True):
         if st.button("🤝 登記還款", use_container_width=True):
             add_entry_dialog(1)
 
+# 操作紀錄 (查帳用) + 復原 / 重做
+recent_ops, undo_count, redo_count = load_recent_operations(ledger_version)
+with st.expander(f"🕓 操作紀錄 (可復原 {undo_count} 步)"):
+    col_undo, col_redo = st.columns(2)
+    with col_undo:
+        if st.button("↩️ 復原上一步", use_container_width=True, disabled=undo_count == 0):
+            try:
+                undo_last_operation()
+            except RuntimeError:
+                st.toast("這一步後來又被別人改過，沒辦法復原", icon="⚠️")
+            else:
+                st.rerun()
+    with col_redo:
+        if st.button("↪️ 重做", use_container_width=True, disabled=redo_count == 0):
+            try:
+                redo_last_operation()
+            except RuntimeError:
+                st.toast("這一步後來又被別人改過，沒辦法重做", icon="⚠️")
+            else:
+                st.rerun()
+
+    if recent_ops:
+        for event in recent_ops:
+            first = event['changes'][0] if event['changes'] else None
+            row = (first['after'] or first['before']) if first else None
+            item_text = (row['Item'] or "") if row else ""
+            more = f" 等 {len(event['changes'])} 筆" if len(event['changes']) > 1 else ""
+            st.caption(f"{event['ts']}　{OP_LABELS.get(event['op'], event['op'])}　{item_text}{more}")
+    else:
+        st.caption("目前還沒有操作紀錄")
+
 # 4. 強制留白 (Spacer) - 解決太擠的問題
 # 在控制島與下方明細之間，強制推開 40px 的距離
 st.markdown("<div style='height: 40px;'></div>", unsafe_allow_html=True)
@@ -462,8 +944,48 @@ if not df.empty:
         except AttributeError:
             selection = st.multiselect("篩選條件", filter_options, label_visibility="collapsed")
 
+    search_query = st.text_input("搜尋項目", placeholder="🔍 搜尋項目，例如：飯錢、燒肉", label_visibility="collapsed")
+
+    # 時間範圍：全部 / 今天 / 旅程第 N 天 / 自訂區間
+    date_index = build_date_index(ledger_version, df)
+    first_day, last_day = date_index['first_day'], date_index['last_day']
+    all_dates_opt = "📅 全部日期"
+    today_opt = "☀️ 今天"
+    custom_opt = "🔎 自訂區間"
+    trip_day_opts = {}
+    if first_day is not None:
+        for n in range((last_day - first_day).days + 1):
+            day = first_day + pd.Timedelta(days=n)
+            trip_day_opts[f"🗓️ 第 {n + 1} 天 ({day:%m-%d})"] = day
+    range_options = [all_dates_opt, today_opt] + list(trip_day_opts) + [custom_opt]
+
+    col_range_1, col_range_2 = st.columns([1.2, 2])
+    with col_range_1:
+        range_choice = st.selectbox("時間範圍", range_options, index=0, label_visibility="collapsed")
+
+    range_start, range_end = None, None
+    if range_choice == today_opt:
+        range_start = pd.Timestamp(datetime.now(TW_TIMEZONE).date())
+        range_end = range_start + pd.Timedelta(days=1)
+    elif range_choice in trip_day_opts:
+        range_start = trip_day_opts[range_choice]
+        range_end = range_start + pd.Timedelta(days=1)
+    elif range_choice == custom_opt:
+        today = pd.Timestamp(datetime.now(TW_TIMEZONE).date())
+        with col_range_2:
+            picked = st.date_input("自訂區間", value=((first_day or today).date(), (last_day or today).date()), label_visibility="collapsed")
+        # 只選了開始日還沒選結束日時，先當成單日
+        if isinstance(picked, (list, tuple)) and len(picked) > 0:
+            range_start = pd.Timestamp(picked[0])
+            range_end = pd.Timestamp(picked[-1]) + pd.Timedelta(days=1)
+
     # --- 1. 執行篩選邏輯 ---
-    filtered_df = df.iloc[::-1]
+    # 先用日期索引切出時間範圍，後面的篩選只處理這一段；新的排上面
+    filtered_df = slice_by_time(date_index, range_start, range_end).iloc[::-1]
+
+    search_hits = get_search_index().search(search_query)
+    if search_hits is not None:
+        filtered_df = filtered_df[filtered_df.index.isin(search_hits)]
 
     if current_view != all_members_opt:
         filtered_df = filtered_df[
@@ -483,68 +1005,41 @@ if not df.empty:
 
     st.caption(f"顯示 {len(filtered_df)} 筆紀錄")
 
+    with st.expander("📈 每日 / 每人花費 (依上面的時間範圍)"):
+        spend_summary = compute_spend_summary(ledger_version, range_start, range_end, df)
+        if spend_summary is None:
+            st.info("這段時間沒有消費")
+        else:
+            daily = spend_summary['daily']
+            daily.index = daily.index.strftime('%m-%d').rename('日期')
+            st.markdown("##### 🗓️ 每日花費")
+            st.dataframe(daily, use_container_width=True)
+            st.markdown("##### 👥 每人分攤")
+            st.dataframe(spend_summary['per_member'], use_container_width=True)
+            if current_view != all_members_opt and current_view in spend_summary['member_daily'].index.get_level_values('Member'):
+                member_daily = spend_summary['member_daily'].loc[current_view].unstack('Currency', fill_value=0)
+                member_daily.index = member_daily.index.strftime('%m-%d').rename('日期')
+                st.markdown(f"##### 🎯 {current_view} 的每日分攤")
+                st.dataframe(member_daily, use_container_width=True)
+
     # --- 2. 畫出卡片 (使用 2 欄式佈局) ---
+    # 卡片 HTML 用內容雜湊去共用快取拿，沒改過的紀錄就不用重新組字串 (key 整本一次算好，這一頁一次查完)
+    card_cache = get_card_cache()
+    card_keys = build_card_keys(ledger_version, df)
+    page_keys = [card_keys[index] for index in filtered_df.index]
+    page_cards = card_cache.get_many(page_keys)
     for i, (index, row) in enumerate(filtered_df.iterrows()):
         
         is_settlement = "還款" in str(row['Item'])
-        currency = row['Currency']
+        is_opening = OPENING_BALANCE_ITEM in str(row['Item'])
         amount = float(row['Amount'])
-        date_str = str(row['Date'])[5:] 
-        item_name = row['Item']
         payer = row['Payer']
         bens = [b.strip() for b in str(row['Beneficiaries']).split(",") if b.strip()]
-        
-        # 聰明金額格式
-        if amount.is_integer():
-            formatted_amount = f"{amount:,.0f}"
-        else:
-            formatted_amount = f"{amount:,.2f}"
-
-        if is_settlement:
-            icon = "🤝"
-            amount_color = "#16A34A" # 綠色
-            amount_display = f"+ {currency} {formatted_amount}"
-        else:
-            icon = "💸"
-            amount_color = "#DC2626" # 紅色
-            amount_display = f"- {currency} {formatted_amount}"
-
-        # --- HTML 組合 ---
-        # 1. 標題列：[圖示] [項目名稱] -------- [金額]
-        # 使用 Flexbox 讓金額自動靠右
-        header_html = f"""
-        <div style="display: flex; justify-content: space-between; align-items: flex-start; margin-bottom: 2px;">
-            <div style="font-weight:bold; font-size:1rem; color:#334155; display:flex; align-items:center; gap:6px;">
-                <span style="font-size:1.2rem;">{icon}</span>
-                <span>{item_name}</span>
-            </div>
-            <div style="font-weight:bold; color:{amount_color}; font-size:1rem; white-space:nowrap; margin-left:8px;">
-                {amount_display}
-            </div>
-        </div>
-        """
 
-        # 2. 成員與日期列
-        # 付款人 Tag
-        payer_html = f"<span style='background-color: #475569; color: white; padding: 1px 6px; border-radius: 6px; font-size: 0.75rem; font-weight: bold; white-space:nowrap;'>{payer}</span>"
-        
-        # 分帳人 Tag (全部顯示，沒有 [:3] 限制)
-        bens_html_parts = []
-        for b in bens:
-            tag = f"<span style='border: 1px solid #CBD5E1; color: #475569; padding: 0px 5px; border-radius: 6px; font-size: 0.75rem; white-space:nowrap;'>{b}</span>"
-            bens_html_parts.append(tag)
-        bens_html = "".join(bens_html_parts)
-        
-        # 組合人員列
-        # 使用我們定義的 .people-container 讓它自動換行
-        people_html = f"""
-        <div class="people-container">
-            {payer_html}
-            <span style='color:#ccc; font-size:0.8rem;'>➜</span>
-            {bens_html}
-            <span style="color:#94A3B8; font-size:0.75rem; margin-left: auto;">{date_str}</span>
-        </div>
-        """
+        card_html = page_cards[i]
+        if card_html is None:
+            card_html = build_card_html(row)
+            card_cache.put(page_keys[i], card_html)
 
         # --- 卡片容器 ---
         with st.container(border=True):
@@ -554,13 +1049,15 @@ if not df.empty:
             
             with c_content:
                 # 這裡把所有資訊一次畫出來
-                st.markdown(header_html + people_html, unsafe_allow_html=True)
+                st.markdown(card_html, unsafe_allow_html=True)
 
             with c_action:
                 # 右邊只放一個編輯按鈕
                 with st.popover("⋮", use_container_width=True):
                     st.markdown("##### 交易詳情")
-                    if not is_settlement and len(bens) > 0:
+                    if is_opening and len(bens) > 0:
+                        st.info(f"📌 上一期還沒結清：{bens[0]} 欠 {payer} 的款項")
+                    elif not is_settlement and len(bens) > 0:
                         avg = amount / len(bens)
                         st.info(f"💰 總額 {amount:,.0f} ÷ {len(bens)} 人 = **{avg:,.1f} /人**")
                     elif is_settlement:
@@ -644,160 +1141,84 @@ if not df.empty:
     except NameError:
         dashboard_view = "👀 全員 (不篩選)"
 
-    grouped = df.groupby('Currency')
-    tabs = st.tabs([f"💵 {curr}" for curr in grouped.groups.keys()])
-    
-    # 定義一個小幫手函數：聰明格式化
-    def smart_fmt(val):
-        if float(val).is_integer():
-            return f"{val:,.0f}"
-        return f"{val:,.2f}"
-
-    for i, (currency, group) in enumerate(grouped):
-        with tabs[i]:
-            # --- A. 計算邏輯 ---
-            balances = {m: 0.0 for m in st.session_state['members']}
-            total_spend = 0.0
-            
-            for index, row in group.iterrows():
-                if "還款" not in str(row['Item']):
-                    total_spend += float(row['Amount'])
-                
-                amt = float(row['Amount'])
-                payer = row['Payer']
-                bens = [b.strip() for b in str(row['Beneficiaries']).split(",") if b.strip()]
-                
-                if payer not in balances: balances[payer] = 0.0
-                if bens:
-                    balances[payer] += amt
-                    split = amt / len(bens)
-                    for b in bens:
-                        if b not in balances: balances[b] = 0.0
-                        balances[b] -= split
-
-            # --- B. 總計 ---
-            avg_spend = total_spend / len(st.session_state['members']) if st.session_state['members'] else 0
-            st.markdown(f"""<div style="display: flex; gap: 20px; margin-bottom: 20px;"><div><small style="color:#888;">TOTAL</small><br><b style="font-size:1.5rem;">{currency} {smart_fmt(total_spend)}</b></div><div style="border-left:1px solid #eee; padding-left:20px;"><small style="color:#888;">AVG/PERSON</small><br><b style="font-size:1.5rem; color:#666;">{currency} {smart_fmt(avg_spend)}</b></div></div>""", unsafe_allow_html=True)
-
-            # --- C. 排序 ---
-            sorted_bal = sorted(balances.items(), key=lambda x: x[1], reverse=True)
-            debtors = sorted([x for x in sorted_bal if x[1] < -0.01], key=lambda x: x[1])
-            creditors = sorted([x for x in sorted_bal if x[1] > 0.01], key=lambda x: x[1], reverse=True)
-            transfer_list = []
-            temp_d = [list(d) for d in debtors]
-            temp_c = [list(c) for c in creditors]
-            id_d, id_c = 0, 0
-            while id_d < len(temp_d) and id_c < len(temp_c):
-                amt = min(abs(temp_d[id_d][1]), temp_c[id_c][1])
-                if amt > 0.01: # 這裡稍微放寬一點容許度
-                    transfer_list.append({'from': temp_d[id_d][0], 'to': temp_c[id_c][0], 'amount': amt})
-                temp_d[id_d][1] += amt
-                temp_c[id_c][1] -= amt
-                if abs(temp_d[id_d][1]) < 0.01: id_d += 1
-                if temp_c[id_c][1] < 0.01: id_c += 1
-
-            # --- D. 個人任務 ---
-            if dashboard_view != "👀 全員 (不篩選)":
-                my_bal = balances.get(dashboard_view, 0)
-                st.markdown(f"##### 🎯 {dashboard_view} 的任務")
-                
-                # 使用 smart_fmt 處理顯示
-                if my_bal > 0.01:
-                    st.markdown(f"""<div class="mission-box premium-card"><div>應收</div><div style="font-size:1.8rem; font-weight:bold;">+{currency} {smart_fmt(my_bal)}</div></div>""", unsafe_allow_html=True)
-                    for t in [x for x in transfer_list if x['to']==dashboard_view]:
-                        st.markdown(f"""
-                        <div class="transfer-ticket">
-                            <div class="ticket-side">
-                                <div class="ticket-label">From</div>
-                                <div class="ticket-name">{t['from']}</div>
-                            </div>
-                            <div class="ticket-center">
-                                <div class="ticket-arrow" style="color:#28a745;">➜</div>
-                                <div class="ticket-amount" style="color:#28a745;">+{smart_fmt(t['amount'])}</div>
-                            </div>
-                            <div class="ticket-side">
-                                <div class="ticket-label">To</div>
-                                <div class="ticket-name">Me</div>
-                            </div>
-                        </div>""", unsafe_allow_html=True)
-                elif my_bal < -0.01:
-                    st.markdown(f"""<div class="mission-box-debt premium-card"><div>應付</div><div style="font-size:1.8rem; font-weight:bold;">-{currency} {smart_fmt(abs(my_bal))}</div></div>""", unsafe_allow_html=True)
-                    for t in [x for x in transfer_list if x['from']==dashboard_view]:
-                        st.markdown(f"""
-                        <div class="transfer-ticket">
-                            <div class="ticket-side">
-                                <div class="ticket-label">From</div>
-                                <div class="ticket-name">Me</div>
-                            </div>
-                            <div class="ticket-center">
-                                <div class="ticket-arrow" style="color:#cf1322;">➜</div>
-                                <div class="ticket-amount" style="color:#cf1322;">-{smart_fmt(t['amount'])}</div>
-                            </div>
-                            <div class="ticket-side">
-                                <div class="ticket-label">To</div>
-                                <div class="ticket-name">{t['to']}</div>
-                            </div>
-                        </div>""", unsafe_allow_html=True)
-                else:
-                    st.success("🎉 帳目已平！")
-                st.divider()
-
-            # --- E. 全員表格 (左) & 轉帳路徑 (右) ---
-            c1, c2 = st.columns([3, 2])
-            with c1:
-                st.markdown("##### 📊 帳務狀態表")
-                html_parts = []
-                html_parts.append('<table class="styled-table"><thead><tr><th>成員</th><th>淨額</th><th>狀態</th></tr></thead><tbody>')
-                
-                for member, net in sorted_bal:
-                    net_val = float(net)
-                    # 🔥 關鍵修正：這裡也套用 smart_fmt
-                    formatted_net = smart_fmt(abs(net_val))
-
-                    if net_val > 0.01:
-                        row_cls = "status-green"
-                        badge = "<span style='background:#f6ffed; color:#4DB6AC; padding:2px 8px; border-radius:10px; font-size:0.8rem; font-weight:bold;'>收錢錢囉✨💰</span>"
-                        color = "#4DB6AC"
-                        txt = f"+{formatted_net}"
-                    elif net_val < -0.01:
-                        row_cls = "status-red"
-                        badge = "<span style='background:#fff1f0; color:#FF8A65; padding:2px 8px; border-radius:10px; font-size:0.8rem; font-weight:bold;'>繳錢錢囉💵</span>"
-                        color = "#FF8A65"
-                        txt = f"-{formatted_net}"
-                    else:
-                        row_cls = "status-gray"
-                        badge = "<span style='color:#888; font-size:0.8rem;'>平帳</span>"
-                        color = "#ccc"
-                        txt = "0"
-                    
-                    row_html = f'<tr class="{row_cls}"><td style="font-weight:500;">{member}</td><td class="tabular-nums" style="color:{color}; font-weight:600;">{txt}</td><td>{badge}</td></tr>'
-                    html_parts.append(row_html)
-                html_parts.append('</tbody></table>')
-                final_table_html = "".join(html_parts)
-                st.markdown(f'<div class="premium-card" style="padding:0; overflow:hidden;">{final_table_html}</div>', unsafe_allow_html=True)
-
-            with c2:
-                st.markdown("##### 🎫 轉帳路徑")
-                if not transfer_list:
-                    st.info("無須轉帳 ✨")
-                else:
-                    for t in transfer_list:
-                        # 🔥 這裡也套用 smart_fmt，確保車票金額也乾淨
-                        st.markdown(f"""
-                        <div class="transfer-ticket">
-                            <div class="ticket-side">
-                                <div class="ticket-label">付款</div>
-                                <div class="ticket-name">{t['from']}</div>
-                            </div>
-                            <div class="ticket-center">
-                                <div class="ticket-arrow">➜</div>
-                                <div class="ticket-amount">${smart_fmt(t['amount'])}</div>
-                            </div>
-                            <div class="ticket-side">
-                                <div class="ticket-label">收款</div>
-                                <div class="ticket-name">{t['to']}</div>
-                            </div>
-                        </div>""", unsafe_allow_html=True)
+    # st.tabs 會把每個分頁的內容都算好畫好，所以改成「選一個幣別，只算那一個」
+    currency_list = list_currencies(ledger_version, df)
+    tab_labels = [f"💵 {curr}" for curr in currency_list]
+    try:
+        selected_tab = st.pills("幣別", tab_labels, default=tab_labels[0], key="dash_currency", label_visibility="collapsed")
+    except AttributeError:
+        selected_tab = st.radio("幣別", tab_labels, horizontal=True, key="dash_currency", label_visibility="collapsed")
+    # 使用者把膠囊取消選取時，退回第一個幣別
+    if selected_tab not in tab_labels:
+        selected_tab = tab_labels[0]
+    currency = currency_list[tab_labels.index(selected_tab)]
+
+    summary = compute_currency_summary(ledger_version, currency, tuple(st.session_state['members']), df)
+    balances = summary['balances']
+    transfer_list = summary['transfer_list']
+
+    # --- B. 總計 ---
+    st.markdown(f"""<div style="display: flex; gap: 20px; margin-bottom: 20px;"><div><small style="color:#888;">TOTAL</small><br><b style="font-size:1.5rem;">{currency} {smart_fmt(summary['total_spend'])}</b></div><div style="border-left:1px solid #eee; padding-left:20px;"><small style="color:#888;">AVG/PERSON</small><br><b style="font-size:1.5rem; color:#666;">{currency} {smart_fmt(summary['avg_spend'])}</b></div></div>""", unsafe_allow_html=True)
+
+    # --- D. 個人任務 ---
+    if dashboard_view != "👀 全員 (不篩選)":
+        my_bal = balances.get(dashboard_view, 0)
+        st.markdown(f"##### 🎯 {dashboard_view} 的任務")
+        
+        # 使用 smart_fmt 處理顯示
+        if my_bal > 0.01:
+            st.markdown(f"""<div class="mission-box premium-card"><div>應收</div><div style="font-size:1.8rem; font-weight:bold;">+{currency} {smart_fmt(my_bal)}</div></div>""", unsafe_allow_html=True)
+            for t in [x for x in transfer_list if x['to']==dashboard_view]:
+                st.markdown(f"""
+                <div class="transfer-ticket">
+                    <div class="ticket-side">
+                        <div class="ticket-label">From</div>
+                        <div class="ticket-name">{t['from']}</div>
+                    </div>
+                    <div class="ticket-center">
+                        <div class="ticket-arrow" style="color:#28a745;">➜</div>
+                        <div class="ticket-amount" style="color:#28a745;">+{smart_fmt(t['amount'])}</div>
+                    </div>
+                    <div class="ticket-side">
+                        <div class="ticket-label">To</div>
+                        <div class="ticket-name">Me</div>
+                    </div>
+                </div>""", unsafe_allow_html=True)
+        elif my_bal < -0.01:
+            st.markdown(f"""<div class="mission-box-debt premium-card"><div>應付</div><div style="font-size:1.8rem; font-weight:bold;">-{currency} {smart_fmt(abs(my_bal))}</div></div>""", unsafe_allow_html=True)
+            for t in [x for x in transfer_list if x['from']==dashboard_view]:
+                st.markdown(f"""
+                <div class="transfer-ticket">
+                    <div class="ticket-side">
+                        <div class="ticket-label">From</div>
+                        <div class="ticket-name">Me</div>
+                    </div>
+                    <div class="ticket-center">
+                        <div class="ticket-arrow" style="color:#cf1322;">➜</div>
+                        <div class="ticket-amount" style="color:#cf1322;">-{smart_fmt(t['amount'])}</div>
+                    </div>
+                    <div class="ticket-side">
+                        <div class="ticket-label">To</div>
+                        <div class="ticket-name">{t['to']}</div>
+                    </div>
+                </div>""", unsafe_allow_html=True)
+        else:
+            st.success("🎉 帳目已平！")
+        st.divider()
+
+    # --- E. 全員表格 (左) & 轉帳路徑 (右) ---
+    c1, c2 = st.columns([3, 2])
+    with c1:
+        st.markdown("##### 📊 帳務狀態表")
+        st.markdown(summary['table_html'], unsafe_allow_html=True)
+
+    with c2:
+        st.markdown("##### 🎫 轉帳路徑")
+        if not transfer_list:
+            st.info("無須轉帳 ✨")
+        else:
+            for ticket_html in summary['tickets_html']:
+                st.markdown(ticket_html, unsafe_allow_html=True)
 else:
     st.info("尚無資料")
 
@@ -807,18 +1228,36 @@ with st.expander("📂 資料庫備份/還原 - 程式人員專用", expanded=Fa
     col_b1, col_b2 = st.columns(2)
     with col_b1:
         st.markdown("#### 📥 下載備份")
-        if os.path.exists(DATA_FILE):
-            with open(DATA_FILE, "rb") as f:
-                st.download_button("下載 .csv 檔", f, file_name="ledger_backup.csv", mime="text/csv")
+        # 下載的是「目前的帳本」(快照 + 之後的操作)，格式跟以前的 CSV 一樣
+        st.download_button("下載 .csv 檔", df[LEDGER_COLUMNS].to_csv(index=False).encode('utf-8'), file_name="ledger_backup.csv", mime="text/csv")
     with col_b2:
         st.markdown("#### 📤 上傳還原")
         up_file = st.file_uploader("選擇檔案", type=["csv"], label_visibility="collapsed")
-        if up_file:
-            pd.read_csv(up_file).to_csv(DATA_FILE, index=False)
-            st.success("還原成功！")
-            time.sleep(1)
-            st.rerun()
+        # 上傳的檔案在 rerun 之後還會留著，記住已經還原過哪個檔，避免一直重複還原
+        # 用 file_id 認這次上傳：同一個檔案還原失敗後重新上傳 (拿到新的 file_id) 就能再試
+        if up_file and st.session_state.get('restored_upload') != up_file.file_id:
+            # 讀檔、檢查欄位、寫回帳本都在背景做；欄位不對會顯示在進度區
+            if start_job("上傳還原", {'ledger', 'history'}, run_restore_job, up_file.getvalue()):
+                st.session_state['restored_upload'] = up_file.file_id
     
+    st.divider()
+    card_stats = get_card_cache().stats()
+    st.caption(f"🧩 卡片快取：命中 {card_stats['hits']} / 未命中 {card_stats['misses']} (命中率 {card_stats['hit_rate']:.0%})，目前存 {card_stats['size']} 張")
+    feed = get_ledger_feed()
+    st.caption(f"🔄 帳本同步：版本 {feed.version}，整本載入 {feed.full_loads} 次 / 增量套用 {feed.applied_events} 筆操作")
+
+    st.divider()
+    st.caption("📚 歷史總覽 (所有封存檔的消費總額)：")
+    if st.button("🔁 重建歷史總覽"):
+        start_job("重建歷史總覽", {'history'}, run_history_summary_job)
+    summary_jobs = [j for j in get_job_runner().snapshot() if j['name'] == "重建歷史總覽" and j['status'] == 'done']
+    if summary_jobs:
+        history_summary = summary_jobs[-1]['result']
+        if history_summary.empty:
+            st.info("還沒有封存檔")
+        else:
+            st.dataframe(history_summary, use_container_width=True)
+
     st.divider()
     st.caption("📜 歷史結算封存檔：")
     if os.path.exists("history"):
@@ -0,0 +1,147 @@
+import io
+import os
+import pandas as pd
+
+# 這個檔案只放「純計算」：不能 import streamlit，
+# 因為背景工作會在另外的 process 裡跑這裡的函數 (app1.py 是 streamlit 腳本，別的 process import 不到)
+
+# --- 設定 ---
+LEDGER_COLUMNS = ['Date', 'Item', 'Payer', 'Amount', 'Currency', 'Beneficiaries']
+# 封存開新局時，沒結清的欠款會用這個名稱帶到新帳本
+OPENING_BALANCE_ITEM = '期初結轉'
+# 項目名稱有這些字的就不算消費 (不列入總額、每日花費)
+NON_SPENDING_KEYWORDS = ['還款', OPENING_BALANCE_ITEM]
+
+# --- 函數：帳本資料小工具 ---
+def row_to_dict(row):
+    # 轉成可以寫進 JSON 的純 Python 值 (NaN -> None)
+    out = {}
+    for c in LEDGER_COLUMNS:
+        v = row[c]
+        if pd.isna(v):
+            out[c] = None
+        elif c == 'Amount':
+            out[c] = float(v)
+        else:
+            out[c] = str(v)
+    return out
+
+def rows_to_dicts(df):
+    # row_to_dict 的整批版本，幾萬筆一起轉比一列一列 iterrows 快很多
+    out = {}
+    for c in LEDGER_COLUMNS:
+        col = df[c].astype(float) if c == 'Amount' else df[c].astype(str)
+        out[c] = col.astype(object).where(df[c].notna(), None)
+    return pd.DataFrame(out, index=df.index).to_dict('records')
+
+def spending_mask(df):
+    # 還款、期初結轉只是把錢搬來搬去，不算消費
+    return ~df['Item'].fillna('').astype(str).str.contains('|'.join(NON_SPENDING_KEYWORDS))
+
+# --- 函數：結算 (淨額 + 轉帳路徑) ---
+def compute_balances(group, members):
+    # 淨額：正的是應收、負的是應付。全部用 groupby 向量化，幾十萬筆也很快
+    amounts = group['Amount'].astype(float)
+    total_spend = float(amounts[spending_mask(group)].sum())
+
+    # 分帳人拆成一人一列 (index 還是原本那筆的 Id)
+    # 沒有付款人或沒有分帳人的紀錄不影響任何人的淨額 (以前會多出一個叫 "nan" 的人)
+    bens = group['Beneficiaries'].where(group['Payer'].notna()).fillna('').astype(str).str.split(',').explode().str.strip()
+    bens = bens[bens != '']
+    counts = bens.groupby(level=0).size()
+
+    has_bens = group.index.isin(counts.index)
+    paid = amounts[has_bens].groupby(group['Payer'][has_bens]).sum()
+    shares = amounts.loc[bens.index].to_numpy() / counts.loc[bens.index].to_numpy()
+    owed = pd.Series(shares).groupby(bens.to_numpy()).sum()
+
+    balances = {m: 0.0 for m in members}
+    for payer in group['Payer'].dropna().unique():
+        balances.setdefault(payer, 0.0)
+    for m, v in paid.items():
+        balances[m] += v
+    for m, v in owed.items():
+        balances[m] = balances.get(m, 0.0) - v
+    return balances, total_spend
+
+def compute_transfers(balances):
+    # 貪婪配對：欠最多的先還給應收最多的
+    sorted_bal = sorted(balances.items(), key=lambda x: x[1], reverse=True)
+    debtors = sorted([x for x in sorted_bal if x[1] < -0.01], key=lambda x: x[1])
+    creditors = sorted([x for x in sorted_bal if x[1] > 0.01], key=lambda x: x[1], reverse=True)
+    transfer_list = []
+    temp_d = [list(d) for d in debtors]
+    temp_c = [list(c) for c in creditors]
+    id_d, id_c = 0, 0
+    while id_d < len(temp_d) and id_c < len(temp_c):
+        amt = min(abs(temp_d[id_d][1]), temp_c[id_c][1])
+        if amt > 0.01: # 這裡稍微放寬一點容許度
+            transfer_list.append({'from': temp_d[id_d][0], 'to': temp_c[id_c][0], 'amount': amt})
+        temp_d[id_d][1] += amt
+        temp_c[id_c][1] -= amt
+        if abs(temp_d[id_d][1]) < 0.01: id_d += 1
+        if temp_c[id_c][1] < 0.01: id_c += 1
+    return sorted_bal, transfer_list
+
+def build_opening_balances(df, members, date_str):
+    # 封存時把還沒結清的欠款，每個幣別用最少筆「期初結轉」帶到新帳本：
+    # 收款人當付款人、欠款人當分帳人，重算淨額就會跟封存前一模一樣
+    rows = []
+    for currency, group in df.groupby('Currency'):
+        balances, _ = compute_balances(group, members)
+        _, transfer_list = compute_transfers(balances)
+        for t in transfer_list:
+            rows.append({
+                'Date': date_str,
+                'Item': f"{OPENING_BALANCE_ITEM}: {t['from']} -> {t['to']}",
+                'Payer': t['to'],
+                'Amount': round(t['amount'], 2),
+                'Currency': currency,
+                'Beneficiaries': t['from'],
+            })
+    return pd.DataFrame(rows, columns=LEDGER_COLUMNS)
+
+# --- 背景工作 (在 process pool 裡跑) ---
+def rename_changes(chunk, target, new_name):
+    # 找出這一段帳本裡有 target 的紀錄，回傳「改名」操作要寫的 changes
+    payer_hit = chunk['Payer'] == target
+    bens_hit = chunk['Beneficiaries'].fillna('').astype(str).str.split(',').apply(lambda names: any(n.strip() == target for n in names))
+    hit = chunk[payer_hit | bens_hit]
+    changes = []
+    for row_id, before in zip(hit.index, rows_to_dicts(hit)):
+        after = dict(before)
+        if after['Payer'] == target:
+            after['Payer'] = new_name
+        if after['Beneficiaries'] is not None:
+            names = after['Beneficiaries'].split(',')
+            after['Beneficiaries'] = ",".join(new_name if n.strip() == target else n.strip() for n in names)
+        if after != before:
+            changes.append({'id': int(row_id), 'before': before, 'after': after})
+    return changes
+
+def export_archive(df, backup_file, members, carry_forward, date_str):
+    # 把目前的帳本存成封存檔，順便算好新帳本要帶過去的期初結轉
+    df[LEDGER_COLUMNS].to_csv(backup_file, index=False)
+    if carry_forward:
+        return build_opening_balances(df, members, date_str)
+    return pd.DataFrame(columns=LEDGER_COLUMNS)
+
+def parse_upload(data):
+    # 上傳還原：讀 CSV、清掉 Unnamed 欄位、檢查欄位齊不齊
+    df = pd.read_csv(io.BytesIO(data))
+    df = df.loc[:, ~df.columns.str.contains('^Unnamed')]
+    missing = [c for c in LEDGER_COLUMNS if c not in df.columns]
+    if missing:
+        raise ValueError(f"檔案缺少欄位：{', '.join(missing)}")
+    return df[LEDGER_COLUMNS]
+
+def summarize_archive(path):
+    # 一個封存檔的總覽：筆數 + 每個幣別的消費總額
+    df = pd.read_csv(path)
+    df = df.loc[:, ~df.columns.str.contains('^Unnamed')]
+    summary = {'封存檔': os.path.basename(path), '筆數': len(df)}
+    if not df.empty:
+        spend = df[spending_mask(df)]
+        for currency, total in spend.groupby('Currency')['Amount'].sum().items():
+            summary[currency] = float(total)
+    return summary
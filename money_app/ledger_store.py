@@ -0,0 +1,390 @@
+import os
+import json
+import threading
+from datetime import datetime, timedelta, timezone
+import pandas as pd
+from ledger_jobs import LEDGER_COLUMNS, rows_to_dicts
+
+# 帳本的檔案讀寫：事件紀錄、快照、共用的「目前帳本」、寫入 / 復原 / 重設，還有成員名單
+# 不 import streamlit，測試和別的程式也能直接 import (整個 server 共用的東西放在模組層，跟 cache_resource 一樣只有一份)
+
+# --- 設定 ---
+# 事件時間用台灣時區 (UTC+8)
+TW_TIMEZONE = timezone(timedelta(hours=8))
+
+# --- 設定檔案路徑 ---
+DATA_FILE = 'trip_ledger.csv'      # 存帳務資料 (快照)
+LOG_FILE = 'ledger_events.jsonl'   # 存帳務操作紀錄 (只會往後加)
+CHECKPOINT_FILE = 'ledger_checkpoint.json'  # 快照做到第幾筆操作
+EVENT_ARCHIVE_FILE = 'history/ledger_events.jsonl'  # 壓縮掉的舊操作紀錄
+CONFIG_FILE = 'members.json'       # 存成員名單
+
+# --- 函數：讀取與儲存成員 ---
+def load_members():
+    if os.path.exists(CONFIG_FILE):
+        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    return []
+
+def save_members(members_list):
+    with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
+        json.dump(members_list, f, ensure_ascii=False)
+
+# --- 函數：帳本儲存 (操作紀錄 + 快照) ---
+# 帳本不再直接覆寫 CSV，而是把每一次「新增 / 修改 / 刪除」當成一筆事件，只往 LOG_FILE 後面加。
+# 目前的帳本 = 快照 (DATA_FILE) + 快照之後的事件重播。事件太多時，背景會把它們壓進新的快照。
+# 每個 change 都帶著「改之前 / 改之後」的整列資料，所以可以復原、重做，也能查帳 (不要再有黑帳!)
+COMPACT_EVERY = 200   # 快照之後累積幾筆事件就觸發背景壓縮
+UNDO_DEPTH = 30       # 壓縮後最多還能復原幾步 (這些操作會留在 LOG_FILE)
+
+# 整個 server 共用一把鎖：寫事件、壓縮、重設帳本都要排隊
+_ledger_lock = threading.RLock()
+# 同一時間只跑一個背景壓縮
+_compaction_guard = threading.Lock()
+
+def get_ledger_lock():
+    return _ledger_lock
+
+def get_compaction_guard():
+    return _compaction_guard
+
+# --- 函數：新事件通知 ---
+# 畫面那邊的快取 (搜尋索引、卡片) 要跟著每一筆新事件更新：自己寫入的、從 LOG_FILE 讀到別人寫的都會通知
+# 用名字登記，streamlit 每次重跑重新登記同一個名字只會換掉，不會越登記越多
+_event_listeners = {}
+
+def set_event_listener(name, listener):
+    _event_listeners[name] = listener
+
+def notify_event(event):
+    for listener in list(_event_listeners.values()):
+        listener(event)
+
+def read_checkpoint():
+    if os.path.exists(CHECKPOINT_FILE):
+        with open(CHECKPOINT_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    return {'seq': 0, 'next_id': None}
+
+def read_events(after_seq=0):
+    events = []
+    if os.path.exists(LOG_FILE):
+        with open(LOG_FILE, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    event = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # 當機時寫到一半的最後一行，略過
+                if event['seq'] > after_seq:
+                    events.append(event)
+    return events
+
+def read_last_event():
+    # 從檔尾往回讀到最後一個換行，不用整個檔案掃一遍
+    if not os.path.exists(LOG_FILE):
+        return None
+    with open(LOG_FILE, 'rb') as f:
+        pos = f.seek(0, os.SEEK_END)
+        # 一次往回讀一塊，只在新讀到的那塊找換行 (改名這種一筆就幾十 MB 的事件也不會越讀越慢)
+        chunks = []
+        while pos > 0:
+            step = min(65536, pos)
+            pos -= step
+            f.seek(pos)
+            chunk = f.read(step)
+            if not chunks:
+                chunk = chunk.rstrip(b'\n')  # 檔尾的換行不算
+                if not chunk:
+                    continue
+            cut = chunk.rfind(b'\n')
+            if cut >= 0:
+                chunks.append(chunk[cut + 1:])
+                break
+            chunks.append(chunk)
+        line = b''.join(reversed(chunks))
+    if not line.strip():
+        return None
+    try:
+        return json.loads(line)
+    except json.JSONDecodeError:
+        events = read_events()
+        return events[-1] if events else None
+
+def get_ledger_version():
+    # 帳本版本 = 最後一筆事件的序號 (快照之後沒有事件就用快照的序號)
+    # 壓縮不會改變版本，所以壓縮完快取也不會失效
+    last = read_last_event()
+    return max(last['seq'] if last else 0, read_checkpoint()['seq'])
+
+def read_snapshot():
+    if os.path.exists(DATA_FILE):
+        df = pd.read_csv(DATA_FILE)
+        # 如果發現有 'Unnamed: 0' 這種奇怪的欄位 (Excel 或舊存檔造成的)，直接刪除
+        df = df.loc[:, ~df.columns.str.contains('^Unnamed')]
+        if 'Id' not in df.columns:
+            # 舊版帳本沒有 Id，就照列號編 (第一次壓縮時會把 Id 寫進快照)
+            df.insert(0, 'Id', range(len(df)))
+        return df.set_index('Id')[LEDGER_COLUMNS]
+    return pd.DataFrame(columns=LEDGER_COLUMNS, index=pd.Index([], name='Id', dtype='int64'))
+
+def apply_events(df, events):
+    # 只看每個 Id 最後的樣子：after 是 None 就是被刪掉，否則就用 after 取代整列
+    # 因為是「設定成某個狀態」而不是「加減」，同一筆事件重播兩次結果也一樣
+    latest = {}
+    for event in events:
+        for change in event['changes']:
+            latest[change['id']] = change['after']
+    if not latest:
+        return df
+    df = df.drop(index=[i for i in latest if i in df.index])
+    added = [dict(after, Id=i) for i, after in latest.items() if after is not None]
+    if added:
+        df = pd.concat([df, pd.DataFrame(added, columns=['Id'] + LEDGER_COLUMNS).set_index('Id')])
+        df['Amount'] = df['Amount'].astype(float)
+    # 新增的 Id 一定比較大，通常已經是排好的，不用再排
+    if not df.index.is_monotonic_increasing:
+        df = df.sort_index()
+    return df
+
+def read_new_events(offset):
+    # 從上次讀到的位置往後讀，只吃完整的行 (別人寫到一半的那行留到下次)
+    if not os.path.exists(LOG_FILE):
+        return [], 0  # 封存 / 還原之後還沒有人記帳
+    with open(LOG_FILE, 'rb') as f:
+        f.seek(offset)
+        data = f.read()
+    end = data.rfind(b'\n') + 1
+    events = []
+    for line in data[:end].splitlines():
+        if not line.strip():
+            continue
+        try:
+            events.append(json.loads(line))
+        except json.JSONDecodeError:
+            continue
+    return events, offset + end
+
+class LedgerFeed:
+    # 整個 server 共用一份「目前的帳本」(唯讀，拿到的人不能改它)
+    # 別人存了新帳時，只從 LOG_FILE 上次讀到的位置往後讀新事件疊上去，不用整本重讀
+    # 讀的時候拿帳本鎖：壓縮 / 封存 / 還原換快照、檢查點、LOG_FILE 都在鎖裡面，不會讀到一半的狀態；
+    # 寫入的人拿著帳本鎖也可以來讀 (RLock)，不會互卡
+    def __init__(self):
+        self.version = None
+        self.df = None
+        self.checkpoint = None
+        self.log_offset = 0
+        self.full_loads = 0
+        self.applied_events = 0
+
+    def latest(self):
+        # 回傳 (版本, 帳本) 一組；快取請用這裡拿到的版本當 key，資料才會跟 key 對得上
+        with get_ledger_lock():
+            self.catch_up()
+            return self.version, self.df
+
+    def full_load(self):
+        checkpoint = read_checkpoint()
+        events, self.log_offset = read_new_events(0)
+        events = [e for e in events if e['seq'] > checkpoint['seq']]
+        self.df = apply_events(read_snapshot(), events)
+        self.version = events[-1]['seq'] if events else checkpoint['seq']
+        self.checkpoint = checkpoint
+        self.full_loads += 1
+
+    def catch_up(self):
+        if self.df is None:
+            return self.full_load()
+        checkpoint = read_checkpoint()
+        if checkpoint != self.checkpoint:
+            # 壓縮 / 封存 / 還原換了新的 LOG_FILE：從新檔的開頭讀
+            self.checkpoint = checkpoint
+            self.log_offset = 0
+        # 一般情況：LOG_FILE 只有往後長，讀新增的部分就好
+        events, offset = read_new_events(self.log_offset)
+        if checkpoint['seq'] > self.version and (not events or events[0]['seq'] > self.version + 1):
+            # 快照比我們新，新的 LOG_FILE 又沒留著我們缺的那幾筆 (封存 / 還原，或落後太多)，只能整本重讀
+            return self.full_load()
+        self.log_offset = offset
+        events = [e for e in events if e['seq'] > self.version]
+        if not events:
+            return
+        self.df = apply_events(self.df, events)
+        self.version = events[-1]['seq']
+        self.applied_events += len(events)
+        # 搜尋索引這些也跟著增量更新 (自己寫入的事件已經通知過，聽的人會自己略過)
+        for event in events:
+            notify_event(event)
+
+_ledger_feed = LedgerFeed()
+
+def get_ledger_feed():
+    return _ledger_feed
+
+def load_ledger():
+    # 回傳 (版本, 帳本)；帳本是共用的 DataFrame，只能讀，要改請先 copy
+    return get_ledger_feed().latest()
+
+def append_event(op, changes, target=None):
+    # 寫入就是在檔尾加一行 (O(1))。新增的紀錄 id 是 None，在這裡配發新的 Id
+    lock = get_ledger_lock()
+    with lock:
+        checkpoint = read_checkpoint()
+        last = read_last_event()
+        seq = max(last['seq'] if last else 0, checkpoint['seq']) + 1
+        next_id = last['next_id'] if last else checkpoint['next_id']
+        if next_id is None:
+            snapshot = read_snapshot()
+            next_id = int(snapshot.index.max()) + 1 if len(snapshot) else 0
+        for change in changes:
+            if change['id'] is None:
+                change['id'] = next_id
+                next_id += 1
+            else:
+                change['id'] = int(change['id'])
+        event = {
+            'seq': seq,
+            'ts': datetime.now(TW_TIMEZONE).strftime('%Y-%m-%d %H:%M:%S'),
+            'op': op,
+            'changes': changes,
+            'next_id': next_id,
+        }
+        if target is not None:
+            event['target'] = target
+        with open(LOG_FILE, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(event, ensure_ascii=False) + "\n")
+        pending = seq - checkpoint['seq']
+
+    if pending >= COMPACT_EVERY:
+        start_background_compaction(lock)
+    return event
+
+def write_snapshot(df, seq, next_id):
+    # 先寫暫存檔再 os.replace，讀的人不會讀到寫一半的快照
+    tmp_file = DATA_FILE + '.tmp'
+    df[LEDGER_COLUMNS].to_csv(tmp_file, index=True, index_label='Id')
+    os.replace(tmp_file, DATA_FILE)
+    tmp_file = CHECKPOINT_FILE + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump({'seq': seq, 'next_id': next_id}, f)
+    os.replace(tmp_file, CHECKPOINT_FILE)
+
+def archive_events(events):
+    # 壓縮掉的事件不會丟，搬到 history 留底查帳
+    if not events:
+        return
+    if not os.path.exists("history"): os.makedirs("history")
+    with open(EVENT_ARCHIVE_FILE, 'a', encoding='utf-8') as f:
+        for event in events:
+            f.write(json.dumps(event, ensure_ascii=False) + "\n")
+
+def compact_ledger(lock):
+    # 把快照之後的事件壓進新快照，LOG_FILE 只留最後 UNDO_DEPTH 筆
+    with lock:
+        checkpoint = read_checkpoint()
+        events = read_events()
+        pending = [e for e in events if e['seq'] > checkpoint['seq']]
+        if not pending:
+            return
+        df = apply_events(read_snapshot(), pending)
+        write_snapshot(df, pending[-1]['seq'], pending[-1]['next_id'])
+
+        # 從「還能復原的最後 UNDO_DEPTH 筆」和「還能重做的」裡面最舊的那筆開始保留，
+        # 這樣留下來的紀錄重算出來的復原 / 重做順序跟原本一樣
+        done, undone = get_undo_redo_stacks(events)
+        keep_from = [e['seq'] for e in done[-UNDO_DEPTH:] + undone]
+        cut = min(keep_from) if keep_from else pending[-1]['seq'] + 1
+        keep = [e for e in events if e['seq'] >= cut]
+        archive_events([e for e in events if e['seq'] < cut])
+        tmp_file = LOG_FILE + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            for event in keep:
+                f.write(json.dumps(event, ensure_ascii=False) + "\n")
+        os.replace(tmp_file, LOG_FILE)
+
+def start_background_compaction(lock):
+    # 在背景執行緒壓縮，存檔的人不用等
+    guard = get_compaction_guard()
+    if not guard.acquire(blocking=False):
+        return  # 已經有人在壓縮了
+
+    def run():
+        try:
+            compact_ledger(lock)
+        finally:
+            guard.release()
+
+    threading.Thread(target=run, daemon=True).start()
+
+def reset_ledger(new_df, expected_version=None):
+    # 封存 / 上傳還原：整本換掉。舊的事件全部搬去 history，新快照從下一個序號開始
+    # expected_version：背景工作開始時看到的版本，中途有人存了新帳就不要蓋掉
+    with get_ledger_lock():
+        if expected_version is not None and get_ledger_version() != expected_version:
+            raise RuntimeError("帳本在處理途中有人更新了，請再試一次")
+        seq = get_ledger_version() + 1
+        events = read_events()
+        archive_events(events + [{'seq': seq, 'ts': datetime.now(TW_TIMEZONE).strftime('%Y-%m-%d %H:%M:%S'), 'op': 'reset', 'changes': [], 'rows': len(new_df)}])
+        new_df = new_df[LEDGER_COLUMNS].reset_index(drop=True)
+        write_snapshot(new_df, seq, len(new_df))
+        if os.path.exists(LOG_FILE):
+            os.remove(LOG_FILE)
+
+# --- 函數：寫入帳本 (所有新增 / 修改 / 刪除都走這裡) ---
+def find_stale_changes(df, changes):
+    # before 跟帳本現在的樣子對不上的 Id (before 是 None 代表那時候還沒有這筆，現在卻有了，也算對不上)
+    checked = [c for c in changes if c['id'] is not None]
+    present = [c['id'] for c in checked if c['id'] in df.index]
+    current = dict(zip(present, rows_to_dicts(df.loc[present])))
+    return {c['id'] for c in checked if current.get(c['id']) != c['before']}
+
+def record_operation(op, changes, target=None):
+    with get_ledger_lock():
+        # 卡片、復原用的 before 都是之前讀到的樣子；別人已經改過 / 刪掉就不寫，
+        # 不然會把他的修改蓋掉，或把刪掉的那筆又救回來
+        _, df = load_ledger()
+        if find_stale_changes(df, changes):
+            raise RuntimeError("這筆紀錄剛剛被別人改過或刪掉了，請重新整理後再試")
+        event = append_event(op, changes, target)
+    notify_event(event)
+    return event
+
+def get_undo_redo_stacks(events):
+    # done: 還可以復原的操作；undone: 復原過、還可以重做的操作 (做了新操作就清空)
+    done, undone = [], []
+    for event in events:
+        if event['op'] == 'undo':
+            if done and done[-1]['seq'] == event['target']:
+                undone.append(done.pop())
+        elif event['op'] == 'redo':
+            if undone and undone[-1]['seq'] == event['target']:
+                done.append(undone.pop())
+        elif event['op'] == 'rename':
+            # 改名連成員名單 (members.json) 一起換了，復原只改得回帳本、名單會對不上，所以改名不能復原；
+            # 改名之前的操作記的也是舊名字，復原了會把舊名字寫回去，一起清掉
+            done, undone = [], []
+        else:
+            done.append(event)
+            undone = []
+    return done, undone
+
+def undo_last_operation():
+    with get_ledger_lock():
+        done, _ = get_undo_redo_stacks(read_events())
+        if not done:
+            return None
+        target = done[-1]
+        inverse = [{'id': c['id'], 'before': c['after'], 'after': c['before']} for c in reversed(target['changes'])]
+        return record_operation('undo', inverse, target=target['seq'])
+
+def redo_last_operation():
+    with get_ledger_lock():
+        _, undone = get_undo_redo_stacks(read_events())
+        if not undone:
+            return None
+        target = undone[-1]
+        changes = [dict(c) for c in target['changes']]
+        return record_operation('redo', changes, target=target['seq'])
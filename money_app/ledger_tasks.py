@@ -0,0 +1,179 @@
+import os
+import time
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+import pandas as pd
+import ledger_jobs
+from ledger_jobs import LEDGER_COLUMNS
+from ledger_store import TW_TIMEZONE, get_ledger_lock, get_ledger_version, load_ledger, record_operation, reset_ledger, load_members, save_members
+
+# 背景工作：JobRunner 和改名、封存、上傳還原、重建歷史總覽這幾個工作本身
+# 不 import streamlit (畫面那邊用 cache_resource 拿一個 JobRunner 共用)，測試和壓測也能直接 import
+
+# --- 函數：背景工作 (改名、封存、上傳還原、重建歷史總覽) ---
+# 重的計算丟到 process pool；每個工作有一條 thread 在旁邊等結果、回報進度、寫回帳本，
+# 所以按下按鈕的那個畫面馬上就能繼續用
+JOB_WORKERS = 2          # process pool 開幾個 process
+JOB_CHUNK_ROWS = 50000   # 改名時每一段交給一個 process 的筆數
+JOB_POLL_SECONDS = 1     # 進度條多久更新一次
+JOB_SHOW_DONE_SECONDS = 10  # 做完的工作在畫面上多留幾秒
+
+class JobRunner:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pool = None
+        self.jobs = OrderedDict()
+        self.next_id = 1
+
+    def get_pool(self):
+        # 第一次有工作才開 process pool；用 spawn，不要把 server 的 thread 狀態 fork 過去
+        with self.lock:
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(max_workers=JOB_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+            return self.pool
+
+    def discard_pool(self, pool):
+        with self.lock:
+            if self.pool is pool:
+                self.pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, name, resources, work, *args):
+        # resources：這個工作會動到的東西 ('ledger' / 'history')，有重疊的工作同時只能跑一個
+        with self.lock:
+            for job in self.jobs.values():
+                if job['status'] == 'running' and job['resources'] & set(resources):
+                    return None, job['name']
+            job = {
+                'id': self.next_id,
+                'name': name,
+                'resources': set(resources),
+                'status': 'running',
+                'progress': 0.0,
+                'message': "準備中…",
+                'result': None,
+                'finished': None,
+            }
+            self.jobs[self.next_id] = job
+            self.next_id += 1
+            while len(self.jobs) > 20:
+                self.jobs.popitem(last=False)
+        threading.Thread(target=self.run, args=(job, work, args), daemon=True).start()
+        return job, None
+
+    def run(self, job, work, args):
+        def report(progress, message):
+            with self.lock:
+                job['progress'] = progress
+                job['message'] = message
+        # 狀態和完成時間要在同一次拿鎖裡一起改，別人才不會看到「做完了但沒有完成時間」
+        try:
+            pool = self.get_pool()
+            result = work(pool, report, *args)
+            with self.lock:
+                job['status'] = 'done'
+                job['progress'] = 1.0
+                job['result'] = result
+                job['finished'] = time.time()
+        except BrokenProcessPool:
+            # 有 process 突然死掉 (例如記憶體不夠) 後整個 pool 都不能用了：丟掉，下一個工作會開新的
+            self.discard_pool(pool)
+            with self.lock:
+                job['status'] = 'failed'
+                job['message'] = "背景處理的程式意外結束了，請再試一次"
+                job['finished'] = time.time()
+        except Exception as e:
+            with self.lock:
+                job['status'] = 'failed'
+                job['message'] = str(e)
+                job['finished'] = time.time()
+
+    def snapshot(self):
+        with self.lock:
+            return [dict(job) for job in self.jobs.values()]
+
+    def has_visible_jobs(self):
+        # 還在跑、或剛做完 (結果還要留在畫面上) 的工作
+        now = time.time()
+        with self.lock:
+            return any(job['status'] == 'running' or (job['finished'] and now - job['finished'] < JOB_SHOW_DONE_SECONDS)
+                       for job in self.jobs.values())
+
+def find_touched_ids(df_old, df_new):
+    # 兩個版本之間新增、刪掉、或內容變了的 Id
+    common = df_old.index.intersection(df_new.index)
+    old, new = df_old.loc[common, LEDGER_COLUMNS], df_new.loc[common, LEDGER_COLUMNS]
+    differ = ((old != new) & ~(old.isna() & new.isna())).any(axis=1)
+    return set(common[differ.to_numpy()]) | set(df_old.index.symmetric_difference(df_new.index))
+
+def run_rename_job(pool, report, target, new_name):
+    version, df = load_ledger()
+    chunks = [df.iloc[i:i + JOB_CHUNK_ROWS] for i in range(0, len(df), JOB_CHUNK_ROWS)]
+    futures = [pool.submit(ledger_jobs.rename_changes, chunk, target, new_name) for chunk in chunks]
+    changes = []
+    for done, future in enumerate(as_completed(futures), start=1):
+        changes.extend(future.result())
+        report(0.9 * done / len(futures), f"比對中 {done}/{len(futures)}")
+    # 有改到的每一列都記成同一筆「改名」操作 (查帳看得到；不能復原，見 get_undo_redo_stacks)
+    report(0.95, f"寫入 {len(changes)} 筆…")
+    with get_ledger_lock():
+        # 比對的這段時間有人記了帳：被動過的那幾列照現在的樣子重新比對，
+        # 不然會用開始時讀到的舊內容把別人的修改蓋回去
+        latest_version, df_now = load_ledger()
+        if latest_version != version:
+            touched = find_touched_ids(df, df_now)
+            changes = [c for c in changes if c['id'] not in touched]
+            changes.extend(ledger_jobs.rename_changes(df_now[df_now.index.isin(touched)], target, new_name))
+        if changes:
+            changes.sort(key=lambda c: c['id'])
+            record_operation('rename', changes)
+    # 帳本改成功了才換成員名單 (失敗的話名單維持原樣，才不會跟帳本對不上)
+    save_members([new_name if m == target else m for m in load_members()])
+    return f"{target} → {new_name}，改了 {len(changes)} 筆"
+
+def run_archive_job(pool, report, members, carry_forward):
+    version, df_current = load_ledger()
+    if not os.path.exists("history"): os.makedirs("history")
+    timestamp = pd.Timestamp.now().strftime('%Y%m%d_%H%M%S')
+    backup_file = f"history/ledger_{timestamp}.csv"
+    report(0.1, f"匯出 {len(df_current)} 筆到封存檔…")
+    # 還欠著的錢變成幾筆「期初結轉」，新帳本一開就看得到，不用再回頭翻 history
+    tw_now = datetime.now(TW_TIMEZONE).strftime('%Y-%m-%d %H:%M')
+    # 先匯出到暫存檔：匯出途中有人記了帳，這份封存就不完整，不能留在 history 裡
+    tmp_file = backup_file + ".tmp"
+    try:
+        new_period = pool.submit(ledger_jobs.export_archive, df_current, tmp_file, members, carry_forward, tw_now).result()
+        report(0.7, "開新帳本…")
+        with get_ledger_lock():
+            if get_ledger_version() != version:
+                raise RuntimeError("帳本在處理途中有人更新了，請再試一次")
+            os.replace(tmp_file, backup_file)
+            # 清空 (舊的操作紀錄會一起搬去 history)
+            reset_ledger(new_period, expected_version=version)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    return f"已封存到 {backup_file}，帶過去 {len(new_period)} 筆期初結轉"
+
+def run_restore_job(pool, report, data):
+    version = get_ledger_version()
+    report(0.1, "讀取上傳的檔案…")
+    df_upload = pool.submit(ledger_jobs.parse_upload, data).result()
+    report(0.6, f"寫入 {len(df_upload)} 筆…")
+    reset_ledger(df_upload, expected_version=version)
+    return f"還原成功！共 {len(df_upload)} 筆"
+
+def run_history_summary_job(pool, report):
+    files = sorted(f for f in os.listdir("history") if f.endswith(".csv")) if os.path.exists("history") else []
+    futures = [pool.submit(ledger_jobs.summarize_archive, os.path.join("history", f)) for f in files]
+    rows = []
+    for done, future in enumerate(as_completed(futures), start=1):
+        rows.append(future.result())
+        report(done / len(futures), f"讀取封存檔 {done}/{len(futures)}")
+    if not rows:
+        return pd.DataFrame()
+    return pd.DataFrame(rows).sort_values('封存檔', ascending=False).set_index('封存檔').fillna(0)
@@ -0,0 +1,84 @@
+# 背景工作的壓測：大帳本 + 很多封存檔，量送出工作要多久、每個工作從送出到做完要多久。
+# 不是 pytest 測試 (跑一次要一分鐘左右)，直接執行：
+#     python tests/bench_background_jobs.py            # 預設 30 萬筆帳、50 個 2 萬筆的封存檔
+#     python tests/bench_background_jobs.py 50000 10   # 帳本筆數、封存檔個數
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'money_app'))
+
+import pandas as pd
+
+import ledger_store
+import ledger_tasks
+
+NAMES = ['抖抖', '佩珊', '我', 'A', 'B', 'C']
+ARCHIVE_ROWS = 20000
+
+def make_ledger(rows, archives):
+    rng = random.Random(0)
+    df = pd.DataFrame({
+        'Date': [f"2025-12-{rng.randint(1, 28):02d} {rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}" for _ in range(rows)],
+        'Item': [rng.choice(['飯錢', '燒肉', '車票', '還款: A -> B']) for _ in range(rows)],
+        'Payer': [rng.choice(NAMES) for _ in range(rows)],
+        'Amount': [float(rng.randint(1, 9999)) for _ in range(rows)],
+        'Currency': [rng.choice(['JPY', 'TWD', 'USD']) for _ in range(rows)],
+        'Beneficiaries': [",".join(rng.sample(NAMES, 3)) for _ in range(rows)],
+    })
+    df.to_csv(ledger_store.DATA_FILE, index=False)
+    os.makedirs('history')
+    for i in range(archives):
+        df.iloc[:ARCHIVE_ROWS].to_csv(f"history/ledger_2025{i:04d}.csv", index=False)
+    ledger_store.save_members(NAMES)
+    return df.iloc[:ARCHIVE_ROWS].to_csv(index=False).encode('utf-8')
+
+def run(runner, name, resources, work, *args):
+    start = time.perf_counter()
+    job, busy = runner.submit(name, resources, work, *args)
+    submitted = time.perf_counter() - start
+    if busy:
+        print(f"{name}: 被「{busy}」擋下來")
+        return None
+    while job['status'] == 'running':
+        time.sleep(0.02)
+    result = job['result'] if isinstance(job['result'], str) else job['message'] if job['status'] == 'failed' else "完成"
+    print(f"{name}: 送出 {submitted * 1000:.1f} ms，做完 {time.perf_counter() - start:.2f} s，{job['status']}，{result}")
+    return job
+
+def main(rows, archives):
+    upload = make_ledger(rows, archives)
+    start = time.perf_counter()
+    ledger_store.load_ledger()
+    print(f"帳本 {rows} 筆、封存檔 {archives} 個；第一次讀帳本 {time.perf_counter() - start:.2f} s")
+
+    runner = ledger_tasks.JobRunner()
+    try:
+        # 第一個工作會順便把 process pool 開起來
+        run(runner, "重建歷史總覽 (含開 pool)", {'history'}, ledger_tasks.run_history_summary_job)
+        start = time.perf_counter()
+        job, _ = runner.submit("改名", {'ledger'}, ledger_tasks.run_rename_job, '佩珊', 'Pei')
+        blocked, busy = runner.submit("封存", {'ledger'}, ledger_tasks.run_archive_job, NAMES, True)
+        print(f"改名途中再送封存：{'被擋下來' if blocked is None else '沒被擋！'} ({busy})")
+        while job['status'] == 'running':
+            time.sleep(0.02)
+        print(f"改名: 做完 {time.perf_counter() - start:.2f} s，{job['status']}，{job['result'] or job['message']}")
+        run(runner, "改名 2", {'ledger'}, ledger_tasks.run_rename_job, '抖抖', 'Dou')
+        start = time.perf_counter()
+        ledger_store.load_ledger()
+        print(f"兩次改名之後讀帳本 (只套新事件) {time.perf_counter() - start:.2f} s")
+        run(runner, "封存帳本", {'ledger', 'history'}, ledger_tasks.run_archive_job, ledger_store.load_members(), True)
+        run(runner, f"上傳還原 {ARCHIVE_ROWS} 筆", {'ledger', 'history'}, ledger_tasks.run_restore_job, upload)
+        run(runner, "重建歷史總覽", {'history'}, ledger_tasks.run_history_summary_job)
+    finally:
+        if runner.pool is not None:
+            runner.pool.shutdown()
+
+if __name__ == '__main__':
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 300000
+    archives = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    with tempfile.TemporaryDirectory() as d:
+        os.chdir(d)
+        main(rows, archives)
@@ -0,0 +1,112 @@
+# 背景工作跟別人同時記帳：改名不能把別人剛改的內容蓋回去、封存不能留下不完整的封存檔、
+# 還原不能蓋掉處理途中別人存的新帳。
+# 跑法：python -m pytest tests/test_background_jobs.py
+import os
+import sys
+from concurrent.futures import Future
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'money_app'))
+
+import ledger_store
+import ledger_tasks
+from ledger_jobs import row_to_dict
+
+class InlinePool:
+    # 代替 process pool：在同一個 process 裡直接算，算完 (還沒交回結果前) 先跑 meanwhile，
+    # 模擬「背景工作還在跑的時候，別人記了一筆帳」
+    def __init__(self, meanwhile=None):
+        self.meanwhile = meanwhile
+
+    def submit(self, fn, *args):
+        future = Future()
+        future.set_result(fn(*args))
+        if self.meanwhile:
+            self.meanwhile()
+            self.meanwhile = None
+        return future
+
+def no_report(progress, message):
+    pass
+
+@pytest.fixture
+def ledger(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(ledger_store, '_ledger_feed', ledger_store.LedgerFeed())
+    with open('trip_ledger.csv', 'w', encoding='utf-8') as f:
+        f.write("Date,Item,Payer,Amount,Currency,Beneficiaries\n")
+        for i in range(6):
+            f.write(f"2025-12-11 10:0{i},午餐{i},我,{100 + i},JPY,\"我,佩珊\"\n")
+    ledger_store.save_members(['我', '佩珊'])
+    return tmp_path
+
+def current_row(i):
+    return row_to_dict(ledger_store.load_ledger()[1].loc[i])
+
+def test_rename_keeps_edits_made_while_it_runs(ledger):
+    def someone_else_writes():
+        edited = current_row(0)
+        ledger_store.record_operation('edit', [{'id': 0, 'before': edited, 'after': dict(edited, Amount=999.0)}])
+        ledger_store.record_operation('delete', [{'id': 1, 'before': current_row(1), 'after': None}])
+        ledger_store.record_operation('add', [{'id': None, 'before': None, 'after': dict(edited, Item='宵夜')}])
+
+    ledger_tasks.run_rename_job(InlinePool(someone_else_writes), no_report, '我', '小明')
+
+    _, df = ledger_store.load_ledger()
+    assert df.loc[0, 'Amount'] == 999.0       # 別人的修改還在
+    assert 1 not in df.index                   # 別人刪掉的沒有被救回來
+    assert (df['Payer'] == '小明').all()        # 包括途中新增的那筆，全部都改到了
+    assert (df['Beneficiaries'] == '小明,佩珊').all()
+    assert ledger_store.load_members() == ['小明', '佩珊']
+
+def test_failed_rename_leaves_members_alone(ledger):
+    def worker_dies():
+        raise RuntimeError("worker 掛了")
+
+    with pytest.raises(RuntimeError):
+        ledger_tasks.run_rename_job(InlinePool(worker_dies), no_report, '我', '小明')
+    assert ledger_store.load_members() == ['我', '佩珊']
+    assert (ledger_store.load_ledger()[1]['Payer'] == '我').all()
+
+def test_archive_rejected_when_ledger_changes_leaves_no_file(ledger):
+    def someone_else_writes():
+        edited = current_row(0)
+        ledger_store.record_operation('edit', [{'id': 0, 'before': edited, 'after': dict(edited, Amount=5.0)}])
+
+    version_before = ledger_store.get_ledger_version()
+    with pytest.raises(RuntimeError):
+        ledger_tasks.run_archive_job(InlinePool(someone_else_writes), no_report, ['我', '佩珊'], True)
+
+    assert os.listdir('history') == []         # 沒有半份封存檔，也沒有留下 .tmp
+    _, df = ledger_store.load_ledger()
+    assert len(df) == 6 and df.loc[0, 'Amount'] == 5.0   # 帳本沒被清空，別人的修改還在
+    assert ledger_store.get_ledger_version() == version_before + 1
+
+def test_archive_moves_ledger_into_history(ledger):
+    message = ledger_tasks.run_archive_job(InlinePool(), no_report, ['我', '佩珊'], True)
+
+    files = os.listdir('history')
+    archives = [f for f in files if f.startswith('ledger_') and f.endswith('.csv')]
+    assert len(archives) == 1 and not [f for f in files if f.endswith('.tmp')]
+    assert archives[0] in message
+    _, df = ledger_store.load_ledger()
+    assert len(df) == 1 and df.iloc[0]['Payer'] == '我'  # 佩珊 欠 我 的錢帶到新帳本
+
+def test_restore_rejected_when_ledger_changes(ledger):
+    with open('trip_ledger.csv', 'rb') as f:
+        upload = f.read()
+
+    def someone_else_adds():
+        ledger_store.record_operation('add', [{'id': None, 'before': None, 'after': dict(current_row(0), Item='宵夜')}])
+
+    with pytest.raises(RuntimeError):
+        ledger_tasks.run_restore_job(InlinePool(someone_else_adds), no_report, upload)
+    _, df = ledger_store.load_ledger()
+    assert '宵夜' in set(df['Item'])
+
+def test_has_visible_jobs_while_job_is_finishing(ledger):
+    runner = ledger_tasks.JobRunner()
+    job = {'id': 1, 'name': 'x', 'resources': {'ledger'}, 'status': 'done', 'finished': None}
+    runner.jobs[1] = job
+    assert runner.has_visible_jobs() is False
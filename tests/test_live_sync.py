@@ -0,0 +1,127 @@
+# 多人同時記帳的模擬：很多 session 一邊讀、好幾個人一邊寫 (含修改、刪除、復原、背景壓縮)，
+# 最後每個 session 手上的帳本都要跟「快照 + 事件重播」重新算出來的一模一樣，
+# 而且每個 session 只整本讀過一次，之後都是只讀新事件疊上去。
+# 跑法：python -m pytest tests/test_live_sync.py  或  python tests/test_live_sync.py
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'money_app'))
+
+import ledger_store
+from ledger_jobs import row_to_dict
+
+N_SESSIONS = 40
+N_WRITERS = 8
+WRITES_PER_WRITER = 60
+# 壓縮得勤一點，讀的人才會碰到 LOG_FILE 被換掉；
+# 壓縮後留下的事件比讀的人兩次之間會漏掉的多，接得上就不該整本重讀
+COMPACT_EVERY = 50
+UNDO_DEPTH = 40
+
+def seed_ledger():
+    with open('trip_ledger.csv', 'w', encoding='utf-8') as f:
+        f.write("Date,Item,Payer,Amount,Currency,Beneficiaries\n")
+        for i in range(20):
+            f.write(f"2025-12-11 10:{i:02d},午餐{i},我,{100 + i},JPY,\"我,佩珊\"\n")
+
+def run_simulation():
+    # 每個 session 一份自己的 LedgerFeed (比共用一份更嚴格)
+    feeds = [ledger_store.LedgerFeed() for _ in range(N_SESSIONS)]
+    for feed in feeds:
+        feed.latest()
+    stop = threading.Event()
+    errors = []
+    counts = {'accepted': 0, 'rejected': 0}
+    counts_lock = threading.Lock()
+
+    def writer(w):
+        rng = random.Random(w)
+        for k in range(WRITES_PER_WRITER):
+            _, df = ledger_store.load_ledger()
+            r = rng.random()
+            try:
+                if r < 0.7 or df.empty:
+                    after = {'Date': '2025-12-12 10:00', 'Item': f"w{w}-{k}", 'Payer': '我',
+                             'Amount': float(k), 'Currency': 'JPY', 'Beneficiaries': '我,佩珊'}
+                    event = ledger_store.record_operation('add', [{'id': None, 'before': None, 'after': after}])
+                elif r < 0.85:
+                    i = rng.choice(list(df.index))
+                    before = row_to_dict(df.loc[i])
+                    event = ledger_store.record_operation('edit', [{'id': i, 'before': before, 'after': dict(before, Amount=before['Amount'] + 1)}])
+                elif r < 0.95:
+                    i = rng.choice(list(df.index))
+                    event = ledger_store.record_operation('delete', [{'id': i, 'before': row_to_dict(df.loc[i]), 'after': None}])
+                else:
+                    event = ledger_store.undo_last_operation()
+                outcome = 'accepted' if event is not None else None
+            except RuntimeError:
+                outcome = 'rejected'  # 別人剛改過同一筆，正確地被擋下來
+            if outcome:
+                with counts_lock:
+                    counts[outcome] += 1
+
+    def reader(feed):
+        while not stop.is_set():
+            try:
+                feed.latest()
+            except Exception as e:
+                errors.append(repr(e))
+            time.sleep(0.005)
+
+    readers = [threading.Thread(target=reader, args=(feed,)) for feed in feeds]
+    writers = [threading.Thread(target=writer, args=(w,)) for w in range(N_WRITERS)]
+    for t in readers + writers:
+        t.start()
+    for t in writers:
+        t.join()
+    stop.set()
+    for t in readers:
+        t.join()
+    while ledger_store.get_compaction_guard().locked():
+        time.sleep(0.05)
+
+    # 正確答案：不靠任何快取，直接從快照 + 事件重播
+    checkpoint = ledger_store.read_checkpoint()
+    expected = ledger_store.apply_events(ledger_store.read_snapshot(), ledger_store.read_events(after_seq=checkpoint['seq']))
+    version = ledger_store.get_ledger_version()
+    results = [feed.latest() for feed in feeds]
+    return dict(counts, **{
+        'errors': errors,
+        'version': version,
+        'compacted_to': checkpoint['seq'],
+        'expected_rows': len(expected),
+        'consistent': sum(1 for v, df in results if v == version and df.equals(expected)),
+        'full_loads': max(feed.full_loads for feed in feeds),
+        'applied_events': min(feed.applied_events for feed in feeds),
+    })
+
+def test_sessions_stay_consistent(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(ledger_store, 'COMPACT_EVERY', COMPACT_EVERY)
+    monkeypatch.setattr(ledger_store, 'UNDO_DEPTH', UNDO_DEPTH)
+    monkeypatch.setattr(ledger_store, '_ledger_feed', ledger_store.LedgerFeed())
+    seed_ledger()
+    result = run_simulation()
+    assert result['errors'] == []
+    assert result['consistent'] == N_SESSIONS
+    # 被擋下來的寫入一筆都沒寫進去：每一筆成功的寫入剛好讓版本 +1
+    assert result['accepted'] + result['rejected'] > 0
+    assert result['version'] == result['accepted']
+    # 只有第一次整本讀，之後 (包括壓縮換了 LOG_FILE) 都只讀新事件
+    assert result['compacted_to'] > 0
+    assert result['full_loads'] == 1
+    assert result['applied_events'] > 0
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as d:
+        os.chdir(d)
+        ledger_store.COMPACT_EVERY, ledger_store.UNDO_DEPTH = COMPACT_EVERY, UNDO_DEPTH
+        seed_ledger()
+        start = time.time()
+        result = run_simulation()
+        print(f"{N_WRITERS} 人各寫 {WRITES_PER_WRITER} 次、{N_SESSIONS} 個 session 同時讀，{time.time() - start:.1f} 秒")
+        print(result)